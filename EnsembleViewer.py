@@ -27,6 +27,33 @@ from module_mixins import IntrospectModuleMixin
 from comedi_utils import CMSliceViewer
 from comedi_utils import SyncSliceViewers
 from isovalue_utils import Isovalue
+from ensemble_utils import PlanLoader
+from ensemble_utils import EnsembleCache
+from ensemble_utils import EnsembleStack
+from statistics_utils import EnsembleStatistics
+from statistics_utils import EnsemblePercentiles
+from statistics_utils import BootstrapStatistics
+from statistics_utils import ProbabilityCube
+from statistics_utils import HistogramCube
+from statistics_utils import BinnedDensity
+from statistics_utils import RunningStatistics
+from statistics_utils import PlanSelection
+from statistics_utils import PlanInfluence
+from statistics_utils import VoxelTable
+from ensemble_utils import array_to_image
+from ensemble_utils import read_plan
+from ensemble_utils import file_digest
+from dvh_utils import EnsembleDVH
+from dvh_utils import ROITable
+from modes_utils import PrincipalModes
+from distance_utils import PlanDistances
+from distance_utils import k_medoids
+from distance_utils import hierarchical_clusters
+from gamma_utils import GammaIndex
+from boxplot_utils import ContourBandDepth
+from boxplot_utils import BoxplotPool
+from boxplot_utils import BoxplotCache
+from boxplot_utils import BandVolumes
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 
 #from interactors import MouseInteractorHighLightActor
@@ -42,6 +69,7 @@ import vtk
 import wx
 import re
 import collections
+import hashlib
 import operator
 from operator import itemgetter
 from vtk.util import numpy_support
@@ -210,7 +238,6 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self.ymin = 0
         self.ymax = 0
 		
-        self.doseplans = {}		
 		
         self.isovalues_barplot = []
         self.band_depths = []
@@ -241,12 +268,17 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self.isovalues = {}
         self.median_outliers_ids = {}
 		
+        #Band volumes of the contour boxplot, derived on demand from the ranking: "i{isovalue}" -> vtkImageData
         self.image_data50 = {}
         self.image_data100 = {}		
+        #Bars shown while the isovalues of the contour boxplot are being computed, and the time they were last drawn
+        self.streamed_bars = []
+        self.streamed_time = 0
 		
         self.isovalue = 60
 		
-        self.planlist = []
+        self.stack = None
+        self.nr_doseplans = 0
 		
 		
         self.barplot_data = {}
@@ -287,6 +319,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self.scBar3d = vtk.vtkScalarBarActor()
         self.scBarWidget = vtk.vtkScalarBarWidget()
 		
+        self.statistics = None
         self.mindata = None
         self.maxdata = None
         self.diffdata = None
@@ -299,10 +332,37 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
         self.item = None
 		
-        self.meanx = []
-        self.stdy = []
+        self.voxel_table = None
+        self.selector = None
+        self.plan_selection = None
+        self.percentiles = None
+        self.bootstrap = None
+        self.probability_cube = None
+        self.histogram_cube = None
+        self.density = None
+        self.principal_modes = None
+        #Leave-one-out influence of the (included) plans on the mean and std
+        self.plan_influence = None
+        #Gamma index of the (included) plans and its reference, None for the mean plan
+        self.gamma_index = None
+        self.gamma_reference = None
+        self.overlays = {}
+		
+        #Label volumes with the structures of every patient: patient -> (file path, (Z, Y, X) labels)
+        self.structures = {}
+        #Dose volume histograms and structure statistics: (patient, structures file, included plans) -> EnsembleDVH/ROITable
+        self.dvh_cache = {}
+        self.roi_cache = {}
+        #Plan distance matrices: (patient, metric, included plans) -> PlanDistances
+        self.distance_cache = {}
+        #Cluster of every clustered plan, plan -> (cluster, is medoid)
+        self.plan_clusters = {}
+        #Structure statistic per structure, {label: [[plan, value], ...]} like contours_info
+        self.roi_info = {}
 		
         self.count = 0
+        #Axes of the colorbar of the heatmap, reused when the heatmap is drawn again
+        self.heatmap_cbar_ax = None
 		
         self.radio_id = 9
 		
@@ -353,6 +413,73 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 
         # anything you stuff into self._config will be saved
         self._config.last_used_dir = ''
+		
+        # size and kind ('thread' or 'process') of the pool used to decode the dose plans,
+        # 0 workers means one worker per core. The VTK 5 reader holds the GIL, so threads decode serially
+        self._config.load_workers = 0
+        self._config.load_mode = 'process'
+
+        # number of threads computing the ensemble statistics slab by slab (0 means one per core)
+        # and the cache size in bytes the slabs are sized for
+        self._config.statistics_workers = 0
+        self._config.statistics_cache_size = 2 * 1024 * 1024
+
+        # memory budget in MB for ensembles that do not fit in memory, 0 keeps the ensemble in memory.
+        # With a budget the plans always go through a binary cache on disk and are streamed in z-slabs
+        self._config.memory_budget_mb = 0
+        # without a budget the decoded plans are also kept in a binary cache on disk (False reads the files
+        # every time), in ensemble_cache_dir or next to the patient volume ('')
+        self._config.ensemble_cache = True
+        self._config.ensemble_cache_dir = ''
+
+        # refresh the mean/std overlays every n decoded plans while an ensemble is loading, 0 disables it
+        self._config.progressive_refresh = 10
+
+        # width in Gy of the dose bins of the per voxel histograms behind the distribution plots
+        self._config.histogram_bin_width = 1.0
+        # number of voxel densities kept for the distribution plot
+        self._config.density_cache_size = 512
+        # width in Gy of the dose bins of the dose volume histograms
+        self._config.dvh_bin_width = 0.5
+
+        # distance between dose plans for the clustering: 'l2' (root mean square) or 'max' (largest absolute difference)
+        self._config.plan_distance = 'l2'
+        # clustering of the dose plans: 'kmedoids' or 'hierarchical', and the number of clusters
+        self._config.cluster_method = 'kmedoids'
+        self._config.nr_clusters = 3
+
+        # gamma analysis: dose difference in % of the maximum reference dose, distance to agreement in mm,
+        # low dose threshold in % of the maximum reference dose and the largest gamma searched for
+        self._config.gamma_dose_criterion = 3.0
+        self._config.gamma_distance_criterion = 3.0
+        self._config.gamma_threshold = 10.0
+        self._config.gamma_max = 2.0
+
+        # bootstrap confidence intervals of the mean and std: number of replicates, confidence level in %
+        # and the seed of the resampling, so that the intervals are reproducible
+        self._config.bootstrap_replicates = 1000
+        self._config.bootstrap_confidence = 95.0
+        self._config.bootstrap_seed = 0
+
+        # contour boxplot: fraction of voxels that may violate the containment in a band (0 is the strict
+        # band depth), and a directory with offline rankings to use instead ('' computes them)
+        self._config.band_depth_epsilon = 0.0
+        self._config.isovalues_dir = ''
+        # 'exact' pairwise band depth, rank based 'modified' band depth, or 'auto' (modified above 100 plans).
+        # The outliers differ: depth 0 (in no band of two other plans) for 'exact', below the Tukey fence
+        # (lower quartile - 1.5 IQR of the depths) for 'modified', so 'auto' changes the rule above 100 plans
+        self._config.band_depth_method = 'auto'
+        # the isovalues of the contour boxplot are computed concurrently, in a pool of 'process' or 'thread'
+        # workers (0 means one worker per core)
+        self._config.boxplot_workers = 0
+        self._config.boxplot_mode = 'process'
+        # seconds between the redraws of the barplot and heatmap while the isovalues come in
+        self._config.boxplot_redraw_interval = 1.0
+        # directory of the contour boxplot cache, addressed by the content of the plan files ('' keeps it next to the plans)
+        self._config.boxplot_cache_dir = ''
+        # number of 50% and 100% band volumes of the contour boxplot kept in memory, each, the others are
+        # derived again from the ensemble when shown
+        self._config.band_cache_size = 4
 
         # make our window appear (this is a viewer after all)
         self.view()
@@ -581,35 +708,60 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self.renDP.GetActiveCamera().SetParallelScale(100)
         self.renDP.GetActiveCamera().Modified()
 		
-    def load_plan_from_file(self, filelist):
-        """Loads dose plans data from files - creates and overlays an average dose plan from these
+    def load_plan_from_file(self, filelist, cache_path=None):
+        """Loads dose plans data from files - creates and overlays an average dose plan from these.
+        If a cache_path is given, the plans are read from (or first written to) a binary ensemble cache,
+        which is also what the memory budget streams the plans from.
         """
 
-        self.planlist=[]
-		
-        for i in range(len(filelist)):
-            file_path = filelist[i]
-            self._view_frame.SetStatusText( "Opening plans: %s..." % (file_path))
-            filename = os.path.split(file_path)[1]
-            fileBaseName =os.path.splitext(filename)[0]
-			
-            reader = vtk.vtkXMLImageDataReader()
-            reader.SetFileName(file_path)
-            reader.GetOutput().SetUpdateExtentToWholeExtent()
-            reader.Update()
-
-            flipYFilter = vtk.vtkImageFlip()
-            flipYFilter.SetFilteredAxis(1)
-            flipYFilter.SetInput(reader.GetOutput())
-            flipYFilter.Update()
-			
-            allined_data = self.put_volume_at_origin(reader.GetOutput())
-			
-            self.planlist.append(flipYFilter.GetOutput())
-			
+        # release the previous ensemble (and its memory-map) before a cache file gets rewritten
+        self.stack = None
+        self.running_statistics = None
         self.nr_doseplans = len(filelist)
+        self.plan_files = list(filelist)
+        #Content digests of the plan files, kept in the ensemble cache or computed when first needed
+        self.plan_digests = None
+		
+        loader = PlanLoader(self._config.load_workers, self._config.load_mode)
+        out_of_core = self._config.memory_budget_mb > 0
+		
+        if cache_path is not None:
+            cache = EnsembleCache(cache_path)
+            valid = cache.is_valid(filelist)
+            try:
+                if not valid:
+                    cache.build(filelist, loader, self._plan_loaded_callback)
+                else:
+                    self._view_frame.SetStatusText( "Opening plans from cache: %s..." % (cache_path))
+                data, meta = cache.open()
+                self.stack = EnsembleStack(data, self.spacing, cache if out_of_core else None)
+                self.plan_digests = meta['digests']
+            except (IOError, OSError) as e:
+                #A read-only directory or a full disk only costs the cache, the plans are read in memory
+                self._view_frame.SetStatusText("Could not use the ensemble cache, reading the plans in memory: %s" % (e))
+                self.running_statistics = None
+                if not valid and os.path.isfile(cache_path):
+                    try:
+                        os.remove(cache_path)
+                    except OSError:
+                        pass
+		
+        if self.stack is None:
+            self.stack = EnsembleStack.from_files(filelist, self.spacing, loader, self._plan_loaded_callback)
+		
+        self.running_statistics = None
+        self.plan_selection = None
+		
+        #The histograms and structure statistics of an earlier ensemble of this patient are outdated
+        self.plan_clusters = {}
+        self.gamma_reference = None
+        for cache in (self.dvh_cache, self.roi_cache, self.distance_cache):
+            for key in cache.keys():
+                if key[0] == self.item:
+                    del cache[key]
 		
         self._view_frame.nrdp = self.nr_doseplans
+        self.fill_plan_list(filelist)
 		
         self.create_average_plan()
 		
@@ -618,113 +770,125 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self._view_frame.slices_sliderC.SetValue(int(float(self.image_data.GetBounds()[1])/float(self.image_data.GetSpacing()[0])/2))
 
         #self._handler_slices(None)
+		
+    def fill_plan_list(self, filelist):
+        """ List the dose plans of the ensemble in the patient pane, all of them included """
+		
+        plan_list = self._view_frame.plan_list
+        plan_list.DeleteAllItems()
+        self.checkboxes_doseplans = {}
+		
+        for plan, file_path in enumerate(filelist):
+            idx = plan_list.InsertStringItem(sys.maxint, label = "", it_kind=1)
+            plan_list.SetStringItem(idx, 1, os.path.split(file_path)[1])
+            item = plan_list.GetItem(idx, 0)
+            item.Check(True)
+            plan_list.SetItem(item)
+            self.checkboxes_doseplans[plan] = True
+			
+    def OnCheckDoseplan(self, event):
+        plan = event.GetIndex()
+        included = self._view_frame.plan_list.GetItem(plan, 0).IsChecked()
+		
+        try:
+            self.set_plan_included(plan, included)
+        except ValueError as e:
+            #Undo the check change, the statistics need at least one plan
+            item = self._view_frame.plan_list.GetItem(plan, 0)
+            item.Check(not included)
+            self._view_frame.plan_list.SetItem(item)
+            self._view_frame.SetStatusText(str(e))
+			
+    def set_plan_included(self, plan, included):
+        """ Include or exclude a dose plan from the statistics, overlays and scatterplot """
+		
+        if self.plan_selection is None:
+            self._view_frame.SetStatusText("Caching the sums of the dose plans...")
+            self.plan_selection = PlanSelection(self.stack.data, self.statistics, **self._ensemble_engine_options()).compute()
+			
+        if not self.plan_selection.set_included(plan, included):
+            return
+        self.checkboxes_doseplans[plan] = included
+		
+		#The images wrap the statistics volumes, they only have to be told that the values changed
+        self.volume_array[...] = np.clip(self.statistics.mean, 0, 255)
+        for image in (self.mindata, self.maxdata, self.diffdata, self.plandata, self.stddata, self.volumedata):
+            image.Modified()
+        self.clear_derived_overlays()
+			
+        self.create_lut_for_normal_overlay()
+        self.refresh_3d()
+		
+        if self.voxel_table is not None:
+            self.voxel_table = VoxelTable(self.stack.data, self.statistics, self.voxel_table.bounds)
+            self.scatterPlot()
+			
+        self._view_frame.SetStatusText("Statistics of %d out of %d dose plans" % (self.statistics.nr_doseplans, self.nr_doseplans))
+		
+    def _plan_loaded_callback(self, index, file_path, plan):
+        """ Report the progress of the plan loader in the status bar and fold the plan into the progressive overlays """
+		
+        refresh = self._config.progressive_refresh
+        if refresh > 0:
+            if self.running_statistics is None:
+                self.running_statistics = RunningStatistics(plan[0].shape)
+            self.running_statistics.add(plan[0])
+			
+            if (index + 1) % refresh == 0 and index + 1 < self.nr_doseplans:
+                self.show_running_statistics()
+		
+        self._view_frame.SetStatusText( "Opening plans (%d/%d): %s..." % (index + 1, self.nr_doseplans, file_path))
+        wx.SafeYield(None, True)
+		
+    def show_running_statistics(self):
+        """ Overlay the mean/std of the plans decoded so far, they are replaced by create_average_plan once all plans are read """
+		
+        running = self.running_statistics.refresh()
+        if not np.any(running.mean) or not np.any(running.std):
+            return
+		
+        if self.statistics is not running:
+            self.statistics = running
+            self.plandata = array_to_image(running.mean, self.spacing)
+            self.stddata = array_to_image(running.std, self.spacing)
+        else:
+            self.plandata.Modified()
+            self.stddata.Modified()
+			
+        self.create_lut_for_normal_overlay()
+        self._view_frame.SetStatusText("Showing the statistics of %d plans" % (running.nr_doseplans))
 	
 		
     def create_average_plan(self):
 
-        dummy_img = self.planlist[0]
-        dummy_img2 = self.planlist[0]
-        dummy_img3 = self.planlist[0]
-
-		#Calculate the mean dose plan
-        if len(self.planlist)>1:
-            for j in range (0, len(self.planlist)):
-                math = vtk.vtkImageMathematics()
-                math.SetOperationToAdd()
-                math.SetInput1(dummy_img)
-                math.SetInput2(self.planlist[j])
-                math.Update()
-                dummy_img = math.GetOutput()
-
-                math2 = vtk.vtkImageMathematics()
-                math2.SetOperationToMin()
-                math2.SetInput1(dummy_img2)
-                math2.SetInput2(self.planlist[j])
-                math2.Update()
-                dummy_img2 = math2.GetOutput()
-
-                math3 = vtk.vtkImageMathematics()
-                math3.SetOperationToMax()
-                math3.SetInput1(dummy_img3)
-                math3.SetInput2(self.planlist[j])
-                math3.Update()
-                dummy_img3 = math3.GetOutput()
-
-        mean_math = vtk.vtkImageMathematics()
-        mean_math.SetInput(dummy_img)
-        mean_math.SetOperationToMultiplyByK()
-        mean_math.SetConstantK(1./len(self.planlist))
-        mean_math.Update()
-		
-        mean_plan = mean_math.GetOutput()
-
-		#Calculate the standard deviation at each voxel
-        temp_deviation = self.planlist[0]
-        temp2_deviation = self.planlist[0]
-		
-        if len(self.planlist)>1:
-            for j in range(0,len(self.planlist)):
-			
-                math1 = vtk.vtkImageMathematics()
-                math1.SetOperationToSubtract()
-                math1.SetInput1(self.planlist[j])
-                math1.SetInput2(mean_plan)
-                math1.Update()
-				
-                math2 = vtk.vtkImageMathematics()
-                math2.SetOperationToSquare()
-                math2.SetInput1(math1.GetOutput())
-                math2.Update()
-				
-                deviation = math2.GetOutput()
-			
-                math3 = vtk.vtkImageMathematics()
-                math3.SetOperationToAdd()
-                math3.SetInput1(temp_deviation)
-                math3.SetInput2(deviation)
-                math3.Update()
-				
-                temp_deviation = math3.GetOutput()
-				
-        subtract_initial = vtk.vtkImageMathematics()
-        subtract_initial.SetOperationToSubtract()
-        subtract_initial.SetInput1(temp_deviation)
-        subtract_initial.SetInput2(temp2_deviation)
-        subtract_initial.Update()
+		#Calculate the mean, minimum, maximum, range and standard deviation at each voxel
+        if self.stack.out_of_core:
+            #Stream the slabs from the cache file, the ensemble itself is never held in memory
+            self.statistics = EnsembleStatistics(self.stack.data, workers=self._config.statistics_workers,
+                                                 read_slab=self.stack.read_slab,
+                                                 memory_budget=self._config.memory_budget_mb * 1024 * 1024).compute()
+        else:
+            self.statistics = EnsembleStatistics(self.stack.data, workers=self._config.statistics_workers,
+                                                 cache_size=self._config.statistics_cache_size).compute()
 		
-        variance = vtk.vtkImageMathematics()
-        variance.SetInput(subtract_initial.GetOutput())
-        variance.SetOperationToMultiplyByK()
-        variance.SetConstantK(1./len(self.planlist))
-        variance.Update()
+        self.clear_derived_overlays()
 		
-        std = vtk.vtkImageMathematics()
-        std.SetOperationToSquareRoot()
-        std.SetInput1(variance.GetOutput())
-        std.Update()
+		#The overlays are views on the float32 statistics, only the volume rendering needs its own unsigned char copy
+        self.volume_array = np.clip(self.statistics.mean, 0, 255).astype(np.uint8)
 		
-        self.mindata = self.put_volume_at_origin(dummy_img2)
-        self.maxdata = self.put_volume_at_origin(dummy_img3)
+        self.mindata = self.stack.volume_image(self.statistics.minimum)
+        self.maxdata = self.stack.volume_image(self.statistics.maximum)
+        self.diffdata = self.stack.volume_image(self.statistics.range)
 
-        math4 = vtk.vtkImageMathematics()
-        math4.SetOperationToSubtract()
-        math4.SetInput1(self.maxdata)
-        math4.SetInput2(self.mindata)
-        math4.Update()
-        self.diffdata = math4.GetOutput()
-
-        self.planext = mean_math.GetOutput().GetExtent()
-        self.plandata = self.put_volume_at_origin2(mean_math.GetOutput())
+        self.planext = self.stack.extent
+        self.plandata = self.stack.volume_image(self.statistics.mean)
 		
-        self.stddata = self.put_volume_at_origin2(std.GetOutput())
+        self.stddata = self.stack.volume_image(self.statistics.std)
 		
-        self.volumedata = self.put_volume_at_origin3(mean_math.GetOutput())
+        self.volumedata = self.stack.volume_image(self.volume_array)
 		
         self.volMapper.SetInput(self.volumedata)
         self.surf.SetInput(self.plandata)
-		
-        for i in range(len(self.planlist)):
-            self.doseplans["p{0}".format(i)] = self.put_volume_at_origin2(self.planlist[i])
 			
         self.xmin = self.plandata.GetExtent()[0]
         self.xmax = self.plandata.GetExtent()[1]
@@ -738,68 +902,19 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 
     def create_lut_for_normal_overlay(self):
 
-        minval_mean = np.min(numpy_support.vtk_to_numpy(self.plandata.GetPointData().GetScalars())[np.nonzero(numpy_support.vtk_to_numpy(self.plandata.GetPointData().GetScalars()))])
-        maxval_mean = np.max(numpy_support.vtk_to_numpy(self.plandata.GetPointData().GetScalars())[np.nonzero(numpy_support.vtk_to_numpy(self.plandata.GetPointData().GetScalars()))])
-
-        minval_std = np.min(numpy_support.vtk_to_numpy(self.stddata.GetPointData().GetScalars())[np.nonzero(numpy_support.vtk_to_numpy(self.stddata.GetPointData().GetScalars()))])
-        maxval_std = np.max(numpy_support.vtk_to_numpy(self.stddata.GetPointData().GetScalars())[np.nonzero(numpy_support.vtk_to_numpy(self.stddata.GetPointData().GetScalars()))])
+        mean = self.statistics.mean
 		
-		#VIRIDIS Color map
-		# First we create a ctf and a otf for the data.
-        '''ctf = vtk.vtkColorTransferFunction()
-        ctf.SetColorSpaceToRGB()
-        ctf.AddRGBPoint(0,0.267, 0.004, 0.329) 
-        ctf.AddRGBPoint(0.2,0.257, 0.256, 0.526) 
-        ctf.AddRGBPoint(0.4, 0.171, 0.452, 0.558) 
-        ctf.AddRGBPoint(0.6,0.121, 0.629, 0.532) 
-        ctf.AddRGBPoint(0.8,0.3779, 0.7918, 0.3779) 
-        ctf.AddRGBPoint(1, 0.866, 0.889, 0.096)'''
+        minval_mean, maxval_mean = self._lut_range(mean)
 		
-		#HEATED-BODY color map
-        ctf = vtk.vtkColorTransferFunction()
-        ctf.SetColorSpaceToRGB()
-        ctf.AddRGBPoint(0,0,0,0) 
-        ctf.AddRGBPoint(0.2,0.462, 0, 0) 
-        ctf.AddRGBPoint(0.4, 0.902, 0, 0) 
-        ctf.AddRGBPoint(0.6, 0.902, 0.443, 0)
-        ctf.AddRGBPoint(0.8, 0.902, 0.647, 0)	
-        ctf.AddRGBPoint(1, 0.902, 0.902, 0)	
-		 
 		#Just to make an otf complete opaque
         otf = vtk.vtkPiecewiseFunction()
         otf.AddPoint(0,1)
         otf.AddPoint(1,1)
 		
-		#------------Create a lut for the mean dose plan----------------
+		#------------Create the luts for the mean and deviations dose plans----------------
 		
-        self.lut_mean = vtk.vtkLookupTable()
-        lutNum_mean = maxval_mean+1
-        self.lut_mean.SetNumberOfTableValues(lutNum_mean)
-
-        for ii in range(0, minval_mean):
-            self.lut_mean.SetTableValue(ii, 0, 0, 0, 0)
-        for ii in range(minval_mean,maxval_mean+1):
-            cc = ctf.GetColor(float(ii-minval_mean)/float(lutNum_mean-minval_mean))
-            oo = otf.GetValue(float(ii-minval_mean)/float(lutNum_mean-minval_mean))
-            self.lut_mean.SetTableValue(ii, cc[0], cc[1], cc[2], oo)
-			
-        self.lut_mean.Modified()
-        self.lut_mean.Build()
-		
-		#-------------Create a lut for deviations dose plan-------------------
-        self.lut_std = vtk.vtkLookupTable()
-        lutNum_std = maxval_std +1
-        self.lut_std.SetNumberOfTableValues(lutNum_std)
-
-        for ii in range(0, minval_std):
-            self.lut_std.SetTableValue(ii, 0, 0, 0, 0)
-        for ii in range(minval_std,maxval_std+1):
-            cc = ctf.GetColor(float(ii-minval_std)/float(lutNum_std-minval_std))
-            oo = otf.GetValue(float(ii-minval_std)/float(lutNum_std-minval_std))
-            self.lut_std.SetTableValue(ii, cc[0], cc[1], cc[2], oo)
-			
-        self.lut_std.Modified()
-        self.lut_std.Build()
+        self.lut_mean, lutNum_mean = self._create_heated_body_lut(mean)
+        self.lut_std, lutNum_std = self._create_heated_body_lut(self.statistics.std)
 		
 		
 		#Yellow-blue color map
@@ -895,10 +1010,6 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         lut50band3.Build()
 		
 			
-        self.slice_viewerA.overlay_ipws[0].SetLookupTable(self.lut_mean)
-        self.slice_viewerS.overlay_ipws[1].SetLookupTable(self.lut_mean)
-        self.slice_viewerC.overlay_ipws[2].SetLookupTable(self.lut_mean)
-		
         self.slice_viewerA.overlay_ipws_100band1[0].SetLookupTable(lut100band1)
         self.slice_viewerS.overlay_ipws_100band1[1].SetLookupTable(lut100band1)
         self.slice_viewerC.overlay_ipws_100band1[2].SetLookupTable(lut100band1)
@@ -923,34 +1034,360 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self.slice_viewerS.overlay_ipws_50band3[1].SetLookupTable(lut50band3)
         self.slice_viewerC.overlay_ipws_50band3[2].SetLookupTable(lut50band3)
 
-        self.scBar_mean.SetLookupTable(self.lut_mean)
-        self.scBar_mean.SetNumberOfLabels(2)
-        self.scBar_mean.SetTitle('Radiation (Gy)')
-        self.scBar_mean.SetMaximumNumberOfColors(lutNum_mean)
-        self.scBar_mean.SetPosition(0.80,0.17)
+        self._setup_scalar_bar(self.scBar_mean, self.lut_mean, lutNum_mean, 'Radiation (Gy)')
         #self.scBar.SetWidth(0.05)
         #self.scBar.VisibilityOn()
         #self.scBar.Modified()
         #self.renA.AddActor2D(self.scBar)
 		
-        self.scBar_std.SetLookupTable(self.lut_std)
-        self.scBar_std.SetNumberOfLabels(2)
-        self.scBar_std.SetTitle('Standard Deviation ')
-        self.scBar_std.SetMaximumNumberOfColors(lutNum_std)
-        self.scBar_std.SetPosition(0.80,0.17)
+        self._setup_scalar_bar(self.scBar_std, self.lut_std, lutNum_std, 'Standard Deviation ')
 		
 		# create the scalar_bar_widget
         self.scBarWidget.SetInteractor(self._view_frame.axial)
-        self.scBarWidget.SetScalarBarActor(self.scBar_mean)
-
-        self.slice_viewerA.set_overlay_input(self.plandata)
-        self.slice_viewerS.set_overlay_inputS(self.plandata)
-        self.slice_viewerC.set_overlay_inputC(self.plandata)
+		
+		#Colormap overlays that can be selected in the axial pane, the percentile ones are added on demand
+        self.overlays = {'Mean' : (self.plandata, self.lut_mean, self.scBar_mean, False),
+                         'Standard Deviation' : (self.stddata, self.lut_std, self.scBar_std, False)}
+		
+        self.show_colormap()
         self.slice_viewerA.render()
         self.slice_viewerS.render()
         self.slice_viewerC.render()
         self._view_frame.SetStatusText("Opened plan file from patient " + self.item)
 		
+    def _lut_range(self, array):
+        """ The integer range of the nonzero values of an array, (0, 0) when there are none """
+        nonzero = array[np.nonzero(array)]
+        if nonzero.size == 0:
+            return 0, 0
+        return int(np.min(nonzero)), int(np.ceil(np.max(nonzero)))
+		
+    def _create_heated_body_lut(self, array):
+        """ Create a heated-body lut spanning the nonzero values of array, returns the lut and its number of colors """
+		
+        minval, maxval = self._lut_range(array)
+		
+		#HEATED-BODY color map
+        ctf = vtk.vtkColorTransferFunction()
+        ctf.SetColorSpaceToRGB()
+        ctf.AddRGBPoint(0,0,0,0) 
+        ctf.AddRGBPoint(0.2,0.462, 0, 0) 
+        ctf.AddRGBPoint(0.4, 0.902, 0, 0) 
+        ctf.AddRGBPoint(0.6, 0.902, 0.443, 0)
+        ctf.AddRGBPoint(0.8, 0.902, 0.647, 0)	
+        ctf.AddRGBPoint(1, 0.902, 0.902, 0)	
+		
+        lut = vtk.vtkLookupTable()
+        lutNum = maxval + 1
+        lut.SetNumberOfTableValues(lutNum)
+
+        for ii in range(0, minval):
+            lut.SetTableValue(ii, 0, 0, 0, 0)
+        for ii in range(minval, maxval + 1):
+            cc = ctf.GetColor(float(ii-minval)/float(lutNum-minval))
+            lut.SetTableValue(ii, cc[0], cc[1], cc[2], 1)
+			
+        lut.Modified()
+        lut.Build()
+		
+        return lut, lutNum
+		
+    def _setup_scalar_bar(self, scalar_bar, lut, nr_colors, title):
+        scalar_bar.SetLookupTable(lut)
+        scalar_bar.SetNumberOfLabels(2)
+        scalar_bar.SetTitle(title)
+        scalar_bar.SetMaximumNumberOfColors(nr_colors)
+        scalar_bar.SetPosition(0.80,0.17)
+		
+    def create_percentile_overlays(self):
+        """ Compute the percentile volumes of the (included) plans and register them as colormap overlays """
+		
+        self.percentiles = EnsemblePercentiles(self.stack.data, **self._ensemble_engine_options()).compute(
+            self._engine_progress("Computing the percentiles of the dose plans"))
+			
+        volumes = [('Median', self.percentiles.median, 'Median (Gy)'),
+                   ('Interquartile Range', self.percentiles.iqr, 'Interquartile Range (Gy)')]
+        for p in (5, 25, 75, 95):
+            volumes.append(('P%d' % p, self.percentiles.volumes[p], 'Percentile %d (Gy)' % p))
+			
+        for name, array, title in volumes:
+            lut, nr_colors = self._create_heated_body_lut(array)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, title)
+            self.overlays[name] = (self.stack.volume_image(array), lut, scalar_bar, False)
+			
+        self._view_frame.SetStatusText("Computed the percentiles of %d dose plans" % (self.percentiles.nr_doseplans))
+		
+    def create_bootstrap_overlays(self):
+        """ Compute bootstrap confidence intervals of the mean and std of the (included) plans and register them as colormap overlays """
+		
+        self._view_frame.SetStatusText("Computing the bootstrap confidence intervals of the mean and std...")
+		
+        self.bootstrap = BootstrapStatistics(self.stack.data, self._config.bootstrap_replicates, self._config.bootstrap_confidence,
+                                             self._config.bootstrap_seed, **self._ensemble_engine_options()).compute()
+        bootstrap = self.bootstrap
+        level = '%g%% CI' % (bootstrap.confidence)
+		
+        volumes = []
+        for statistic, lower, upper in (('Mean', bootstrap.mean_lower, bootstrap.mean_upper),
+                                        ('Std', bootstrap.std_lower, bootstrap.std_upper)):
+            volumes.append(('%s CI Lower' % statistic, lower, '%s %s Lower (Gy)' % (statistic, level)))
+            volumes.append(('%s CI Upper' % statistic, upper, '%s %s Upper (Gy)' % (statistic, level)))
+            volumes.append(('%s CI Width' % statistic, upper - lower, '%s %s Width (Gy)' % (statistic, level)))
+			
+        for name, array, title in volumes:
+            lut, nr_colors = self._create_heated_body_lut(array)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, title)
+            self.overlays[name] = (self.stack.volume_image(array), lut, scalar_bar, False)
+			
+        self._view_frame.SetStatusText("Computed %d bootstrap replicates of %d dose plans" % (bootstrap.replicates, bootstrap.nr_doseplans))
+		
+    def _ensemble_engine_options(self):
+        """ Keyword arguments for the slab engines, restricted to the included plans """
+		
+        options = {'workers' : self._config.statistics_workers}
+        if self.plan_selection is not None and not self.plan_selection.included.all():
+            options['plans'] = np.nonzero(self.plan_selection.included)[0]
+			
+        if self.stack.out_of_core:
+            options['read_slab'] = self.stack.read_slab
+            options['memory_budget'] = self._config.memory_budget_mb * 1024 * 1024
+        else:
+            options['cache_size'] = self._config.statistics_cache_size
+        return options
+		
+    def isodose_probability(self, threshold):
+        """ The fraction of (included) plans delivering at least threshold Gy, per voxel """
+		
+        if self.probability_cube is None:
+            self._view_frame.SetStatusText("Computing the isodose probabilities of the dose plans...")
+            self.probability_cube = ProbabilityCube(self.stack.data, **self._ensemble_engine_options()).compute()
+			
+        return self.probability_cube.probability(threshold)
+		
+    def dose_histograms(self):
+        """ The histogram cube of the (included) plans over the voxels that receive dose, built on first use """
+		
+        if self.histogram_cube is None:
+            #The cube is built on the first probe, the status bar shows its progress and keeps the window responsive
+            max_dose = np.ceil(np.max(self.statistics.maximum))
+            cube = HistogramCube(self.stack.data, self.statistics.nonzero_count > 0, max_dose,
+                                 self._config.histogram_bin_width, **self._ensemble_engine_options())
+            self.histogram_cube = cube.compute(self._engine_progress("Computing the dose histograms of the voxels"))
+            self.density = BinnedDensity(self.histogram_cube, self._config.density_cache_size)
+            self._view_frame.SetStatusText("Computed the dose histograms of %d voxels" % (len(self.histogram_cube.counts)))
+			
+        return self.histogram_cube
+		
+    def _engine_progress(self, text):
+        """ A callback for the slab engines that reports the finished slabs in the status bar """
+		
+        def callback(done, total):
+            self._view_frame.SetStatusText("%s (%d/%d slabs)..." % (text, done, total))
+            wx.SafeYield(None, True)
+        return callback
+		
+    def create_probability_overlay(self, threshold):
+        """ Register the probability of receiving at least threshold Gy as a colormap overlay (in percent), returns its name """
+		
+        name = 'Isodose Probability %d' % (threshold)
+        if name not in self.overlays:
+            array = self.isodose_probability(threshold) * 100
+            lut, nr_colors = self._create_heated_body_lut(array)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, 'P(dose >= %d Gy) (%%)' % (threshold))
+            self.overlays[name] = (self.stack.volume_image(array), lut, scalar_bar, False)
+        return name
+		
+    def _create_diverging_lut(self, limit, centre=0):
+        """ Create a blue-white-red lut for values in [centre - limit, centre + limit] """
+		
+        ctf = vtk.vtkColorTransferFunction()
+        ctf.SetColorSpaceToDiverging()
+        ctf.AddRGBPoint(0, 0.230, 0.299, 0.754)
+        ctf.AddRGBPoint(0.5, 0.865, 0.865, 0.865)
+        ctf.AddRGBPoint(1, 0.706, 0.016, 0.150)
+		
+        lut = vtk.vtkLookupTable()
+        lutNum = 256
+        lut.SetNumberOfTableValues(lutNum)
+        for ii in range(lutNum):
+            cc = ctf.GetColor(float(ii)/float(lutNum-1))
+            lut.SetTableValue(ii, cc[0], cc[1], cc[2], 1)
+        lut.SetTableRange(centre - limit, centre + limit)
+        lut.Modified()
+        lut.Build()
+		
+        return lut, lutNum
+		
+    def create_mode_overlays(self, nr_modes=3):
+        """ Compute the principal modes of variation of the (included) plans in the dose region and register them as overlays """
+		
+        self._view_frame.SetStatusText("Computing the principal modes of the dose plans...")
+		
+        options = self._ensemble_engine_options()
+        self.principal_modes = PrincipalModes(self.stack.data, nr_modes, self.statistics.nonzero_count > 0, **options).compute()
+        modes = self.principal_modes
+		
+		#Every mode is shown in Gy, as the standard deviation of the plans along it
+        for k in range(modes.nr_modes):
+            array = modes.modes[k] * np.float32(modes.singular_values[k] / np.sqrt(modes.nr_doseplans))
+            limit = max(float(np.max(np.abs(array))), 1e-6)
+            lut, nr_colors = self._create_diverging_lut(limit)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, 'Mode %d (%.0f%%)' % (k + 1, modes.explained[k] * 100))
+            self.overlays['Mode %d' % (k + 1)] = (self.stack.volume_image(array), lut, scalar_bar, True)
+			
+		#Scores of every included plan along the modes
+        plans = options.get('plans', np.arange(self.nr_doseplans))
+        for plan in range(self.nr_doseplans):
+            self._view_frame.plan_list.SetStringItem(plan, 2, "")
+        for plan, scores in zip(plans, modes.scores):
+            self._view_frame.plan_list.SetStringItem(plan, 2, ", ".join("%.1f" % (score) for score in scores))
+			
+        self._view_frame.SetStatusText("Computed %d modes of %d dose plans" % (modes.nr_modes, modes.nr_doseplans))
+		
+    def gamma_analysis(self, reference=None):
+        """ The gamma index of the (included) plans against the mean plan, or against the plan with index reference """
+		
+        if self.gamma_index is None or self.gamma_reference != reference:
+            if reference is None:
+                text = "Computing the gamma index of the dose plans against the mean plan"
+                reference_dose = self.statistics.mean
+            else:
+                text = "Computing the gamma index of the dose plans against dose plan %d" % (reference)
+                reference_dose = self.stack.data[reference]
+				
+            options = self._ensemble_engine_options()
+            self.gamma_index = GammaIndex(self.stack.data, reference_dose, self.stack.spacing, self._config.gamma_dose_criterion,
+                                          self._config.gamma_distance_criterion, self._config.gamma_threshold,
+                                          self._config.gamma_max, **options).compute(self._engine_progress(text))
+            self.gamma_reference = reference
+            self.gamma_plans = options.get('plans', np.arange(self.nr_doseplans))
+			
+            for name in self.overlays.keys():
+                if name.startswith('Gamma Index'):
+                    del self.overlays[name]
+					
+            for plan in range(self.nr_doseplans):
+                self._view_frame.plan_list.SetStringItem(plan, 4, "")
+            for plan, pass_rate in zip(self.gamma_plans, self.gamma_index.pass_rates):
+                self._view_frame.plan_list.SetStringItem(plan, 4, "%.1f" % (pass_rate * 100))
+				
+            self._view_frame.SetStatusText("Gamma %g%%/%gmm: mean pass rate %.1f%%" % (self._config.gamma_dose_criterion,
+                                           self._config.gamma_distance_criterion, np.mean(self.gamma_index.pass_rates) * 100))
+			
+        return self.gamma_index
+		
+    def _selected_plan(self):
+        """ The dose plan selected in the plan list, the first dose plan when none is selected """
+        plan = self._view_frame.plan_list.GetFirstSelected()
+        return max(plan, 0)
+		
+    def create_gamma_overlay(self, plan):
+        """ Register the gamma volume of a plan as a colormap overlay, returns its name """
+		
+        gamma = self.gamma_analysis(self.gamma_reference)
+        positions = list(self.gamma_plans)
+        if plan not in positions:
+            #Excluded plans have no gamma volume
+            plan = positions[0]
+			
+        name = 'Gamma Index %d' % (plan)
+        if name not in self.overlays:
+            self._view_frame.SetStatusText("Computing the gamma volume of dose plan %d..." % (plan))
+            array = gamma.volume(plan)
+			#Passing voxels are blue, failing ones red
+            lut, nr_colors = self._create_diverging_lut(1, 1)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, 'Gamma DP %d (%.1f%%)' % (plan, gamma.pass_rates[positions.index(plan)] * 100))
+            self.overlays[name] = (self.stack.volume_image(array), lut, scalar_bar, True)
+        return name
+		
+    def leave_one_out_influence(self):
+        """ The influence of every (included) plan on the mean and std over the dose region, built on first use """
+		
+        if self.plan_influence is None:
+            options = self._ensemble_engine_options()
+            self.plan_influence = PlanInfluence(self.stack.data, self.statistics, self.statistics.nonzero_count > 0, **options).compute(
+                self._engine_progress("Computing the leave-one-out influence of the dose plans"))
+            self.influence_plans = list(options.get('plans', np.arange(self.nr_doseplans)))
+			
+        return self.plan_influence
+		
+    def create_influence_overlay(self, name, plan):
+        """ Register the change of the mean or std when leaving out a plan as a colormap overlay, returns its name """
+		
+        influence = self.leave_one_out_influence()
+        if plan not in self.influence_plans:
+            #Leaving out an excluded plan changes nothing
+            plan = self.influence_plans[0]
+			
+        plan_name = '%s %d' % (name, plan)
+        if plan_name not in self.overlays:
+            mean_change, std_change = influence.maps(plan)
+            array = mean_change if name == 'Influence on Mean' else std_change
+            limit = max(float(np.max(np.abs(array))), 1e-6)
+            lut, nr_colors = self._create_diverging_lut(limit)
+            scalar_bar = vtk.vtkScalarBarActor()
+            self._setup_scalar_bar(scalar_bar, lut, nr_colors, '%s without DP %d (Gy)' % (name.split()[-1], plan))
+            self.overlays[plan_name] = (self.stack.volume_image(array), lut, scalar_bar, True)
+        return plan_name
+		
+    def clear_derived_overlays(self):
+        """ Forget the percentile and probability volumes, they are computed again when one of them is selected """
+        self.percentiles = None
+        self.bootstrap = None
+        self.probability_cube = None
+        self.histogram_cube = None
+        self.density = None
+        self.principal_modes = None
+        self.plan_influence = None
+        self.gamma_index = None
+        for name in self.overlays.keys():
+            if name not in ('Mean', 'Standard Deviation'):
+                del self.overlays[name]
+		
+    def show_colormap(self, name=None):
+        """ Overlay the colormap selected in the axial pane (or name) on the slice viewers """
+		
+        if name is None:
+            name = self._view_frame.colormap_choice.GetValue()
+			
+        if name not in self.overlays:
+            if self.stack is None:
+                #The percentiles and probabilities need the whole ensemble, while loading only the running statistics exist
+                name = 'Mean'
+            elif name == 'Isodose Probability':
+                name = self.create_probability_overlay(self._view_frame.probability_spin.GetValue())
+            elif name == 'Gamma Index':
+                name = self.create_gamma_overlay(self._selected_plan())
+            elif name.startswith('Influence'):
+                name = self.create_influence_overlay(name, self._selected_plan())
+            elif ' CI ' in name:
+                self.create_bootstrap_overlays()
+            elif name.startswith('Mode'):
+                self.create_mode_overlays()
+                if name not in self.overlays:
+                    #Fewer plans than modes
+                    name = 'Mode 1'
+            else:
+                self.create_percentile_overlays()
+				
+        image, lut, scalar_bar, fixed_range = self.overlays[name]
+		
+		#Luts with a fixed range (diverging color maps) should not be rescaled to the range of the image
+        for ipw in (self.slice_viewerA.overlay_ipws[0], self.slice_viewerS.overlay_ipws[1], self.slice_viewerC.overlay_ipws[2]):
+            ipw.SetLookupTable(lut)
+            ipw.SetUserControlledLookupTable(int(fixed_range))
+        self.slice_viewerA.set_overlay_input(image)
+        self.slice_viewerC.set_overlay_inputC(image)
+        self.slice_viewerS.set_overlay_inputS(image)
+		
+		#Colorbar
+        self.scBarWidget.SetScalarBarActor(scalar_bar)
+		
     def put_volume_at_origin(self,data):
         """ This is needed to 'allineate' all datasets
         """
@@ -1118,12 +1555,20 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf.Bind(wx.EVT_MENU, self._handler_max_image_view, id=vf.views_max_image_id)
         vf.Bind(wx.EVT_MENU, self._handler_contour_view, id=vf.views_contour_view_id)
         vf.Bind(wx.EVT_MENU, self._handler_voxel_view, id=vf.views_voxel_view_id)
+        vf.Bind(wx.EVT_MENU, self._handler_load_structures, id=vf.analysis_structures_id)
+        vf.Bind(wx.EVT_MENU, self._handler_dvh, id=vf.analysis_dvh_id)
+        vf.Bind(wx.EVT_MENU, self._handler_cluster_plans, id=vf.analysis_clusters_id)
+        vf.Bind(wx.EVT_MENU, self._handler_gamma, id=vf.analysis_gamma_id)
+        vf.Bind(wx.EVT_MENU, self._handler_influence, id=vf.analysis_influence_id)
+        vf.roi_metric_choice.Bind(wx.EVT_COMBOBOX, self.OnROIMetric)
 		
         vf.toolbar.Bind(wx.EVT_TOOL, self.OnOpen, vf.load_patient) #Open patient data
         vf.toolbar.Bind(wx.EVT_TOOL, self.OnSave, vf.save) # Save current state
 		
         vf.patient_list.Bind(wx.EVT_LIST_ITEM_RIGHT_CLICK, self.OnRightClickPatient) #pop-up menu on right click
         vf.patient_list.Bind(wx.EVT_LIST_ITEM_SELECTED, self.OnSelect)
+        vf.plan_list.Bind(ulc.EVT_LIST_ITEM_CHECKED, self.OnCheckDoseplan) #include/exclude a plan from the statistics
+        vf.plan_list.Bind(ulc.EVT_LIST_ITEM_SELECTED, self.OnSelectDoseplan) #gamma volume of the selected plan
 
         vf.slices_sliderA.Bind(wx.EVT_SLIDER, lambda evt: self._handler_slices(evt, "sliderA"))
         vf.slices_spinA.Bind(wx.EVT_SPINCTRL, lambda evt: self._handler_slices(evt, "spinA"))
@@ -1146,8 +1591,8 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf.select1.Bind(wx.EVT_RADIOBUTTON, self.OnRadioSelect)
         vf.select2.Bind(wx.EVT_RADIOBUTTON, self.OnRadioSelect)
 		
-        vf.radio_mean.Bind(wx.EVT_RADIOBUTTON, self.OnRadioColorMap)
-        vf.radio_std.Bind(wx.EVT_RADIOBUTTON, self.OnRadioColorMap)
+        vf.colormap_choice.Bind(wx.EVT_COMBOBOX, self.OnColorMap)
+        vf.probability_spin.Bind(wx.EVT_SPINCTRL, self.OnColorMap)
 		
         vf.slices_resetA.Bind(wx.EVT_BUTTON, self._handler_reset_all)
         vf.slices_resetC.Bind(wx.EVT_BUTTON, self._handler_reset_all)
@@ -1233,47 +1678,32 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
         slice_index = self.slice_viewerA.ipws[0].GetSliceIndex()
 		
-        voxel_arrays = []
-		
-        for i in range(len(self.planlist)):
-            extractSlice = vtk.vtkExtractVOI()
-            extractSlice.SetInput(self.doseplans["p{0}".format(i)])
-            extractSlice.SetVOI(self.xmin, self.xmax, self.ymin, self.ymax, slice_index, slice_index)
-            extractSlice.SetSampleRate(1, 1, 1)
-            extractSlice.Update()
-		
-            # creating input source for polydata -> stencil
-            p2s = vtk.vtkPolyDataToImageStencil()
-            p2s.SetInput(path)
-            p2s.SetOutputSpacing(self.plandata.GetSpacing())
-            p2s.SetOutputOrigin(self.plandata.GetOrigin())
-            p2s.Update()
-	
-            #Convert image stencil to vtkImageData
-            stencil = vtk.vtkImageStencil()
-            stencil.SetStencil(p2s.GetOutput())
-            stencil.SetInput(extractSlice.GetOutput())   #input is vtkImageData
-            stencil.ReverseStencilOff()
-            stencil.SetBackgroundColor(1,1,0,1)
-            stencil.SetBackgroundValue(0)
-            stencil.Update()
+        # creating input source for polydata -> stencil
+        p2s = vtk.vtkPolyDataToImageStencil()
+        p2s.SetInput(path)
+        p2s.SetOutputSpacing(self.plandata.GetSpacing())
+        p2s.SetOutputOrigin(self.plandata.GetOrigin())
+        p2s.Update()
 		
-            scalars = stencil.GetOutput().GetPointData().GetScalars()
-            voxels = numpy_support.vtk_to_numpy(scalars)[np.nonzero(numpy_support.vtk_to_numpy(scalars))]
-			
-            voxel_arrays.append(voxels)
-			
-            #print("Doseplan %s" %(i))
-            #print(voxels)
-			
+        #The stencil is evaluated once on a slice of ones, which gives the region mask for all plans
+        ones = np.ones((1, self.stack.ny, self.stack.nx), dtype=np.uint8)
+        ones_slice = array_to_image(ones, self.stack.spacing, self.stack.origin, (self.xmin, self.xmax, self.ymin, self.ymax, slice_index, slice_index))
+	
+        #Convert image stencil to vtkImageData
+        stencil = vtk.vtkImageStencil()
+        stencil.SetStencil(p2s.GetOutput())
+        stencil.SetInput(ones_slice)   #input is vtkImageData
+        stencil.ReverseStencilOff()
+        stencil.SetBackgroundValue(0)
+        stencil.Update()
 		
-        data = list(chain.from_iterable(zip(*voxel_arrays)))
+        region = numpy_support.vtk_to_numpy(stencil.GetOutput().GetPointData().GetScalars()).reshape(self.stack.ny, self.stack.nx) != 0
 		
-        data_per_voxel = [data[x:x+len(self.planlist)] for x in range(0, len(data), len(self.planlist))]
+        #The dose distribution of the region is estimated from the sum of the histograms of its voxels, voxels without dose have none
+        self.dose_histograms()
+        density = self.density.region_density(region, slice_index)
 		
-        for voxel_array in data_per_voxel:
-            voxel_array_np = np.array(voxel_array)
-            sns.distplot(voxel_array_np, rug=True, hist=False, color="r", ax=self._view_frame.ax_violin)
+        self._view_frame.ax_violin.plot(self.density.grid, density, color="r")
         
         self._view_frame.canvas_violin.draw()
 		
@@ -1301,36 +1731,11 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             vtk.vtkMapper.SetResolveCoincidentTopologyPolygonOffsetParameters(10,10)
 			
 
-    def OnRadioColorMap(self,event):
+    def OnColorMap(self,event):
         vf = self._view_frame
 		
         if vf.show_overlay.IsChecked():
-		
-            if str(vf.radio_mean.GetValue()) == "True":
-				#Activate color map for mean
-                self.slice_viewerA.overlay_ipws[0].SetLookupTable(self.lut_mean)
-                self.slice_viewerS.overlay_ipws[1].SetLookupTable(self.lut_mean)
-                self.slice_viewerC.overlay_ipws[2].SetLookupTable(self.lut_mean)
-                self.slice_viewerA.set_overlay_input(self.plandata)
-                self.slice_viewerC.set_overlay_inputC(self.plandata)
-                self.slice_viewerS.set_overlay_inputS(self.plandata)
-				
-				#Colorbar
-                self.scBarWidget.SetScalarBarActor(self.scBar_mean)
-                #self.scBarWidget.On()
-				
-				
-            else:
-                self.slice_viewerA.overlay_ipws[0].SetLookupTable(self.lut_std)
-                self.slice_viewerS.overlay_ipws[1].SetLookupTable(self.lut_std)
-                self.slice_viewerC.overlay_ipws[2].SetLookupTable(self.lut_std)
-                self.slice_viewerA.set_overlay_input(self.stddata)
-                self.slice_viewerC.set_overlay_inputC(self.stddata)
-                self.slice_viewerS.set_overlay_inputS(self.stddata)
-				
-				#Colorbar
-                self.scBarWidget.SetScalarBarActor(self.scBar_std)
-                #self.scBarWidget.On()
+            self.show_colormap()
 
             self.scBarWidget.On()
             self.slice_viewerA.render()
@@ -1338,6 +1743,10 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             self.slice_viewerC.render()
 			
 			
+    def OnSelectDoseplan(self, event):
+        if self._view_frame.colormap_choice.GetValue() in ('Gamma Index', 'Influence on Mean', 'Influence on Std'):
+            self.OnColorMap(event)
+			
     def OnCheckBox(self,event):
         id = event.GetEventObject().GetId()
 		
@@ -1512,7 +1921,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         patientinfo = self._view_frame.patients.get(int(self.item))
 		
         self.load_data_from_file(patientinfo[0])
-        self.load_plan_from_file(patientinfo[1])
+        self.load_plan_from_file(patientinfo[1], self._ensemble_cache_path(patientinfo[0], patientinfo[1]))
 		
         #print(patientinfo[0])
         name_file = os.path.split(patientinfo[0])[1]
@@ -1544,6 +1953,19 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 			
         self._view_frame.SetStatusText( "Done.")
 		
+    def _ensemble_cache_path(self, volume_path, filelist):
+        """ The binary ensemble cache of the plans in filelist, None when the plans are not cached """
+		
+        if not self._config.ensemble_cache and self._config.memory_budget_mb <= 0:
+            return None
+			
+        #The cache is named after the plan files, so the same plans always find the same cache
+        directory = self._config.ensemble_cache_dir or os.path.split(volume_path)[0]
+        base_name = os.path.splitext(os.path.split(volume_path)[1])[0]
+        paths = [os.path.abspath(f) for f in filelist]
+        digest = hashlib.sha1("\n".join(p.encode('utf-8') if isinstance(p, unicode) else p for p in paths)).hexdigest()
+        return os.path.join(directory, "%s_plans_%s.ens" % (base_name, digest[:16]))
+		
     def OnVisible(self,event):
 	
         vf = self._view_frame
@@ -1566,7 +1988,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             self.balloon_coronal.EnabledOn()
 		
             if option == "Contours":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.renA.AddActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.renS.AddActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.renC.AddActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1575,7 +1997,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                     self.balloon_coronal.AddBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)] ,'dose260-' + str(plan) + "\n" + "Isovalue" + str(isovalue))
 					
             elif option == "Median":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1591,7 +2013,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                 self.balloon_coronal.AddBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(median)] ,'dose260-' + str(median) + "\n" + "Isovalue" + str(isovalue))				
 				
             elif option == "Outliers":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1609,7 +2031,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                     self.balloon_coronal.AddBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(median)] ,'dose260-' + str(outlier) + "\n" + "Isovalue" + str(isovalue))					
 		
             elif option == "Bands":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1719,7 +2141,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
 		
             elif option == "100% band":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1829,7 +2251,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
 		
             elif option == "50% band":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1938,7 +2360,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                     self.slice_viewerC.render()
 		
             elif option == "Full contour boxplot":
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -1974,7 +2396,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				    self.slice_viewerC.set_overlay_input_coronal_100band3(self.isovalue_objs[id].band100["i{0}".format(isovalue)])
 					
         else:
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2029,7 +2451,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         item.SetBackgroundColour(colour)
         self._view_frame.isovalue_list.SetItem(item)
 		
-        for plan in range(len(self.planlist)):
+        for plan in range(self.nr_doseplans):
             self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)].GetProperty().SetColor(colour)
 			
         self.slice_viewerA.render()
@@ -2088,7 +2510,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				self.slice_viewerS.set_overlay_input_sagittal_50band3(None)
 				self.slice_viewerC.set_overlay_input_coronal_50band3(None)
 				
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 probability = self.contours_info[isovalue][plan][1]
                 color = temp_ctf.GetColor(probability)
                 opacity = self.otf.GetValue(probability)
@@ -2142,7 +2564,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				self.slice_viewerA.set_overlay_input_axial_50band3(None)
 				self.slice_viewerS.set_overlay_input_sagittal_50band3(None)
 				self.slice_viewerC.set_overlay_input_coronal_50band3(None)
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2159,7 +2581,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             self.balloon_coronal.AddBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(median)] ,'dose260-' + str(median) + "\n" + "Isovalue" + str(isovalue))		
 			
         elif option == "Bands":
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2194,7 +2616,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				self.slice_viewerC.set_overlay_input_coronal_50band3(self.isovalue_objs[id].band50["i{0}".format(isovalue)])
 		
         elif option == "50% band":
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2227,7 +2649,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				self.slice_viewerC.set_overlay_input_coronal_100band3(None)
 				
         elif option == "100% band":
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2281,7 +2703,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				self.slice_viewerA.set_overlay_input_axial_50band3(None)
 				self.slice_viewerS.set_overlay_input_sagittal_50band3(None)
 				self.slice_viewerC.set_overlay_input_coronal_50band3(None)
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2297,7 +2719,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                 self.balloon_coronal.AddBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(outlier)] ,'dose260-' + str(outlier) + "\n" + "Isovalue" + str(isovalue))				
 		
         elif option == "Full contour boxplot":
-            for plan in range(len(self.planlist)):
+            for plan in range(self.nr_doseplans):
                 self.balloon_axial.RemoveBalloon(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                 self.balloon_sagittal.RemoveBalloon(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                 self.balloon_coronal.RemoveBalloon(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2410,27 +2832,11 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf = self._view_frame
         
         if vf.show_overlay.IsChecked():
-		
-			if str(vf.radio_mean.GetValue()) == "True":
-				#Activate color map for mean
-				self.slice_viewerA.overlay_ipws[0].SetLookupTable(self.lut_mean)
-				self.slice_viewerS.overlay_ipws[1].SetLookupTable(self.lut_mean)
-				self.slice_viewerC.overlay_ipws[2].SetLookupTable(self.lut_mean)
-				self.slice_viewerA.set_overlay_input(self.plandata)
-				self.slice_viewerC.set_overlay_inputC(self.plandata)
-				self.slice_viewerS.set_overlay_inputS(self.plandata)
-			else:
-				#Activate color map for std
-				self.slice_viewerA.overlay_ipws[0].SetLookupTable(self.lut_std)
-				self.slice_viewerS.overlay_ipws[1].SetLookupTable(self.lut_std)
-				self.slice_viewerC.overlay_ipws[2].SetLookupTable(self.lut_std)
-				self.slice_viewerA.set_overlay_input(self.stddata)
-				self.slice_viewerC.set_overlay_inputC(self.stddata)
-				self.slice_viewerS.set_overlay_inputS(self.stddata)
+            self.show_colormap()
         else:
-			self.slice_viewerA.set_overlay_input(None)
-			self.slice_viewerC.set_overlay_inputC(None)
-			self.slice_viewerS.set_overlay_inputS(None)
+            self.slice_viewerA.set_overlay_input(None)
+            self.slice_viewerC.set_overlay_inputC(None)
+            self.slice_viewerS.set_overlay_inputS(None)
 		
         self.slice_viewerA.render()
         self.slice_viewerC.render()
@@ -2438,17 +2844,21 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 	
     def _initialize_boxplot(self):
         
-        self.read_isovalues_files('.\\isovaluesadc')	
-
         self._view_frame.SetStatusText( "Processing contour boxplot...")	
 		
-        for k,v in self.isovalues.items():
-    
-            contour_ids = self.calculate_cb_contours(k, v[0])
-            self.median_outliers_ids[k] = contour_ids
+        if self._config.isovalues_dir:
+            self.read_isovalues_files(self._config.isovalues_dir)	
+			
+            for k,v in self.isovalues.items():
     
-            self.calculate_50band(k, v[2])
-            self.calculate_100band(k, v[1])
+                contour_ids = self.calculate_cb_contours(k, v[0])
+                self.median_outliers_ids[k] = contour_ids
+        else:
+            self.calculate_band_depth()
+			
+        #The bands are only derived for the isovalues that are shown
+        self.image_data50 = BandVolumes(self.stack, lambda k: self._band_plans(k, 50), self._config.band_cache_size)
+        self.image_data100 = BandVolumes(self.stack, lambda k: self._band_plans(k, 100), self._config.band_cache_size)
         #print(self.isovalues_barplot)
         #self.isovalues_barplot.sort()
         #print(self.contours_info)
@@ -2477,13 +2887,20 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
     
             line = analysis.readline()
     
+        iso = int(re.findall('\d+|\D+', isovalue)[1])
+		
+        return self._register_ranking(iso, ranking)
+		
+    def _register_ranking(self, iso, ranking):
+        """ Register the band depth of every plan ({plan: depth}) at isovalue iso, returns [median, outliers] """
+		
+        ids = []
+		
         median_contour_id = max(ranking.iteritems(), key=operator.itemgetter(1))[0]
         outliers_ids = [k for k,v in ranking.items() if v==0.0]    
     
         contours = [[k,v] for k,v in ranking.iteritems()] 
 		
-        iso = int(re.findall('\d+|\D+', isovalue)[1])
-		
         self.contours_info.update({iso : contours})
 	
         ids.append(median_contour_id)
@@ -2502,6 +2919,91 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         #self.band_depths.append(uncertainty)
 		
         return ids
+		
+    def calculate_band_depth(self):
+        """ Compute the contour boxplot (band depths, median and outliers) of every isovalue from the ensemble.
+        The isovalues are computed concurrently and shown in the barplot and heatmap as soon as each one is done.
+        """
+		
+        options = self._ensemble_engine_options()
+        plans = [int(plan) for plan in options.get('plans', np.arange(self.nr_doseplans))]
+		
+        method = self._config.band_depth_method
+        if method == 'auto':
+            method = 'modified' if len(plans) > 100 else 'exact'
+			
+        isovalues = ContourBandDepth.ISOVALUES
+		
+        cache = BoxplotCache(self._config.boxplot_cache_dir or os.path.split(self.plan_files[0])[0])
+        if self.plan_digests is None:
+            self.plan_digests = [file_digest(file_path) for file_path in self.plan_files]
+        key = cache.key(self.plan_digests, options.get('plans'), method, self._config.band_depth_epsilon, isovalues)
+        results = cache.load(key)
+		
+        if results is not None:
+            self._view_frame.SetStatusText("Opening contour boxplot from cache: %s..." % (cache.path(key)))
+            for result in results:
+                self._register_boxplot(plans, *result)
+            return
+			
+        results = []
+        self.streamed_time = 0
+        pool = BoxplotPool(self._config.boxplot_workers, self._config.boxplot_mode)
+        for result in pool.imap(self.stack.data, isovalues, method, self._config.band_depth_epsilon,
+                                options.get('plans'), self._config.statistics_cache_size):
+            results.append(result)
+            self._register_boxplot(plans, *result)
+			
+            self._view_frame.SetStatusText("Processing contour boxplot (%d/%d isovalues)..." % (len(results), len(isovalues)))
+            self._stream_boxplot(result[0])
+			
+        for bar in self.streamed_bars:
+            bar.remove()
+        self.streamed_bars = []
+		
+        try:
+            cache.save(key, results)
+        except (IOError, OSError) as e:
+            self._view_frame.SetStatusText("Could not write the contour boxplot cache: %s" % (e))
+		
+    def _register_boxplot(self, plans, iso, depths, median, outliers):
+        """ Register the contour boxplot of isovalue iso, the indices in median and outliers are positions in plans """
+		
+        k = "i{0}".format(iso)
+        self.median_outliers_ids[k] = self._register_ranking(iso, dict(zip(plans, depths)))
+		
+		#The median and outliers come from the engine, the bands are derived from them when shown
+        self.median_outliers_ids[k][0] = plans[median]
+        self.median_outliers_ids[k][1] = [plans[plan] for plan in outliers]
+		
+    def _band_plans(self, k, band):
+        """ The isovalue and the plans spanning the 50% or 100% band of the contour boxplot at isovalue key k """
+		
+        iso = int(k[1:])
+		
+        #The deepest half of the plans, or all plans that are not outliers
+        ranking = sorted(self.contours_info[iso], key=lambda contour: (-contour[1], contour[0]))
+        if band == 50:
+            plans = [contour[0] for contour in ranking[:(len(ranking) + 1) // 2]]
+        else:
+            outliers = set(self.median_outliers_ids[k][1])
+            plans = [contour[0] for contour in ranking if contour[0] not in outliers]
+			
+        return iso, plans
+		
+    def _stream_boxplot(self, iso):
+        """ Add the band depth of a finished isovalue to the barplot, the barplot and heatmap are redrawn at most every boxplot_redraw_interval seconds """
+		
+        vf = self._view_frame
+        self.streamed_bars.extend(vf.axb.bar([iso], [self.barplot_data[iso]], align='center', color='black'))
+		
+        #The isovalues arrive a group at a time, redrawing the whole heatmap for each of them would dominate
+        if time.time() - self.streamed_time < self._config.boxplot_redraw_interval:
+            return
+        vf.canvasb.draw()
+        self.heatMap()
+        wx.SafeYield(None, True)
+        self.streamed_time = time.time()
 
 		
 		
@@ -2523,35 +3025,6 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 			self.isovalues["i{0}".format(index)] = f
 			
 
-    def calculate_50band(self,k,filepath):
-    
-        reader50 = vtk.vtkXMLImageDataReader()
-        reader50.SetFileName(filepath)
-        reader50.Update()
-        
-        #Flip the Y-axis of the image
-        flipYFilter50 = vtk.vtkImageFlip()
-        flipYFilter50.SetFilteredAxis(1) # Specify which axis will be flipped. 0 for x, 1 for y and 2 for z. 
-        flipYFilter50.SetInput(reader50.GetOutput())
-        flipYFilter50.Update()
-
-        self.image_data50[k] = self.put_volume_at_origin2(flipYFilter50.GetOutput())
-	
-	
-    def calculate_100band(self, k, filepath):
-    
-        reader100 = vtk.vtkXMLImageDataReader()
-        reader100.SetFileName(filepath)
-        reader100.Update()
-        
-        flipYFilter100 = vtk.vtkImageFlip()
-        flipYFilter100.SetFilteredAxis(1) 
-        flipYFilter100.SetInput(reader100.GetOutput())
-        flipYFilter100.Update()
-
-        self.image_data100[k] = self.put_volume_at_origin2(flipYFilter100.GetOutput())
-		
-				
     def analyse_checkboxes_isovalue(self, sliceA_index, sliceS_index, sliceC_index):
 		
         vf = self._view_frame
@@ -2575,7 +3048,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                     temp_ctf = self.ctf_blue
                     temp_median = self.median_orange
 			
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     probability = self.contours_info[isovalue][plan][1]
                     color = temp_ctf.GetColor(probability)
                     opacity = self.otf.GetValue(probability)
@@ -2594,7 +3067,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				        self.slice_viewerA.set_overlay_input_axial_100band3(None)
 				        self.slice_viewerS.set_overlay_input_sagittal_100band3(None)
 				        self.slice_viewerC.set_overlay_input_coronal_100band3(None)		
-                    for plan in range(len(self.planlist)):
+                    for plan in range(self.nr_doseplans):
                         self.renA.AddActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                         self.renS.AddActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                         self.renC.AddActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2615,7 +3088,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				        self.slice_viewerS.set_overlay_input_sagittal_100band3(None)
 				        self.slice_viewerC.set_overlay_input_coronal_100band3(None)
             
-                    for plan in range(len(self.planlist)):
+                    for plan in range(self.nr_doseplans):
                         self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                         self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                         self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])		
@@ -2627,7 +3100,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
                     self.isovalue_objs[id].set_contour_color(median, temp_median)
 			
                 elif option == "Bands":
-                    for plan in range(len(self.planlist)):
+                    for plan in range(self.nr_doseplans):
                         self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                         self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                         self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])	
@@ -2658,7 +3131,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				        self.slice_viewerS.set_overlay_input_sagittal_100band3(None)
 				        self.slice_viewerC.set_overlay_input_coronal_100band3(None)
             
-                    for plan in range(len(self.planlist)):
+                    for plan in range(self.nr_doseplans):
                         self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                         self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                         self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2672,7 +3145,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
                 elif option == "Full contour boxplot":
 		
-                    for plan in range(len(self.planlist)):
+                    for plan in range(self.nr_doseplans):
                         self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                         self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                         self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2704,7 +3177,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 				        self.slice_viewerC.set_overlay_input_coronal_100band3(self.isovalue_objs[id].band100["i{0}".format(isovalue)])
 					
             else:
-                for plan in range(len(self.planlist)):
+                for plan in range(self.nr_doseplans):
                     self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(plan)])
                     self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(plan)])
                     self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(plan)])
@@ -2838,7 +3311,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             temp_ctf = self.ctf_blue
 		
 		
-        for plan in range(len(self.planlist)):
+        for plan in range(self.nr_doseplans):
             probability = self.contours_info[isovalue][plan][1]
             color = temp_ctf.GetColor(probability)
             opacity = self.otf.GetValue(probability)
@@ -2939,7 +3412,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
     def _change_contour_color(self, event = None):
         """Handler for color adjustment (Color of selection)
         """
-        for plan in range(len(self.planlist)):
+        for plan in range(self.nr_doseplans):
             self.contour_actors["c{0}".format(plan)].GetProperty().SetColor(self._view_frame.color_picker.GetColour().Get())
         self.slice_viewerA.render()
 		
@@ -2949,12 +3422,28 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf = self._view_frame
         ix, iy = event.xdata, event.ydata
 		
+        #The heatmap columns are the isovalues computed so far in ascending order, then the Influence column
+        isovalues = sorted(self.contours_info)
+        isovalue_at = lambda x: dict(enumerate(sorted(self.contours_info))).get(int(x), np.nan)
+		
         if self.count < 1:
-            self.dc = datacursor(hover=True, axes = vf.axh, keybindings=dict(hide='h', toggle='e'), formatter = lambda **d: "Isovalue: {:.0f}\nDosePlan: {:.0f}\nProbability: {:.4f}".format(d["x"] + 70,self.nr_doseplans - d["y"],d["z"]))  
+            self.dc = datacursor(hover=True, axes = vf.axh, keybindings=dict(hide='h', toggle='e'), formatter = lambda **d: "Isovalue: {:.0f}\nDosePlan: {:.0f}\nProbability: {:.4f}".format(isovalue_at(d["x"]),self.nr_doseplans - d["y"],d["z"]))  
 		
         plan = int(round(self.nr_doseplans - iy,0))
-        iso = int(ix + 70)
-				
+        column = int(ix)
+		
+        if column >= len(isovalues):
+            if self.plan_influence is None:
+                return
+            #The leave-one-out influence column, select the plan for the influence colormaps
+            if plan in self.influence_plans:
+                position = self.influence_plans.index(plan)
+                vf.plan_list.Select(plan)
+                self._view_frame.SetStatusText("Leaving out DP %d changes the mean by %.2f Gy and the std by %.2f Gy (RMS)" %
+                                               (plan, self.plan_influence.mean_change[position], self.plan_influence.std_change[position]))
+            return
+		
+        iso = isovalues[column]
         if self.isovalue_objs:
             probability = self.contours_info[iso][plan][1]
             color = self.ctf_yellow.GetColor(probability)
@@ -2965,7 +3454,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             idx_coronal = self.slice_viewerC.ipws[2].GetSliceIndex()
 			
             for id in range(0,3):
-				for dp in range(len(self.planlist)):
+				for dp in range(self.nr_doseplans):
 					self.renA.RemoveActor(self.isovalue_objs[id].contour_actors_axial["c{0}".format(dp)])
 					self.renS.RemoveActor(self.isovalue_objs[id].contour_actors_sagittal["c{0}".format(dp)])
 					self.renC.RemoveActor(self.isovalue_objs[id].contour_actors_coronal["c{0}".format(dp)])
@@ -2997,36 +3486,34 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         self._view_frame.ax_violin.set_ylim(0, 0.3)
 		
         p = np.array(point)
-        x = p[0]
-        y = p[1]
-        z = p[2]
-		
-        yaxis = []
-        xaxis = []
-		
-        if len(self.planlist)>1:
-            for j in range(self.nr_doseplans):
-                i = self.doseplans["p{0}".format(j)].GetScalarComponentAsDouble(x, y, z, 0)
-                yaxis.append(i)
-                xaxis.append("DosePlan %s" %(j))
+        x = int(p[0])
+        y = int(p[1])
+        z = int(p[2])
 		
-        voxels = np.array(yaxis)
-        doseplans = np.array(xaxis)
+        voxels = self.stack.voxel(x, y, z)
+        self.dose_histograms()
 		
-        sns.distplot(voxels, rug=True, hist=False, ax=self._view_frame.ax_violin)
+        self._view_frame.ax_violin.plot(self.density.grid, self.density.density(x, y, z), color="b")
+        self._view_frame.ax_violin.plot(voxels, np.zeros(len(voxels)), "|", color="b", markersize=20)
         
         self._view_frame.canvas_violin.draw()
         self._view_frame.canvas_scatter.draw_idle()
 	
     def scatterPlot(self):
 	
-        self.points = self._view_frame.ax_scatter.scatter(self.meanx, self.stdy, s = 20, marker='o', c='b', lw = 0.4, picker = 5)
+        if self.selector is not None:
+            self.selector.lasso.disconnect_events()
+		#Remove the points and density contours of a previous table, keeping the labels of the axes
+        for collection in list(self._view_frame.ax_scatter.collections):
+            collection.remove()
+		
+        self.points = self._view_frame.ax_scatter.scatter(self.voxel_table.mean, self.voxel_table.std, s = 20, marker='o', c='b', lw = 0.4, picker = 5)
 		
         viewer = self
         self.selector = SelectFromCollection(viewer, self._view_frame.ax_scatter, self.points)
 		
-        x = np.array(self.meanx)
-        y = np.array(self.stdy)
+        x = self.voxel_table.mean
+        y = self.voxel_table.std
 		
         sns.kdeplot(x, y, cmap = 'autumn', bw = 'silverman', shade=False, shade_lowest=False, ax=self._view_frame.ax_scatter, kwargs={'line_kws':{'color':'cyan'}})
         self._view_frame.canvas_scatter.draw()
@@ -3043,15 +3530,31 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 		
     def heatMap(self):
         #sns.set(font_scale=2.5)
-        doseplans = pd.read_csv('C:\\Users\\pedro_000\\Desktop\\EnsembleViewerFinal\\heatmap.csv')
+        #The same table create_csv_file writes, built from the isovalues that are done so far
+        doseplans = pd.DataFrame([{'Isodose': k, 'Doseplans': 'DP ' + str(info[0]), 'Probabilities': info[1]}
+                                  for k, v in self.contours_info.items() for info in v])
         doseplans_data = doseplans.pivot("Doseplans", "Isodose", "Probabilities")
+		
+        if self.plan_influence is not None:
+            #Leave-one-out influence on the std, relative to the most influential plan
+            influence = self.plan_influence.std_change / max(np.max(self.plan_influence.std_change), 1e-12)
+            plans = [int(label.split()[-1]) for label in doseplans_data.index]
+            doseplans_data['Influence'] = [influence[self.influence_plans.index(plan)] if plan in self.influence_plans else np.nan
+                                           for plan in plans]
+			
         cmap = sns.light_palette("#4d4d4d", as_cmap=True, reverse = True)
-        g = sns.heatmap(doseplans_data, vmin=0, vmax=1, ax = self._view_frame.axh, cbar = True, annot=False, cmap=cmap, picker = True)
+        self._view_frame.axh.cla()
+        if self.heatmap_cbar_ax is not None:
+            self.heatmap_cbar_ax.cla()
+        g = sns.heatmap(doseplans_data, vmin=0, vmax=1, ax = self._view_frame.axh, cbar = True, cbar_ax = self.heatmap_cbar_ax, annot=False, cmap=cmap, picker = True)
+        if self.heatmap_cbar_ax is None:
+            self.heatmap_cbar_ax = self._view_frame.figh.axes[-1]
         
         for item in g.get_yticklabels():
             item.set_rotation(0)
             item.set_size(14)
 		
+        self.color_heatmap_clusters()
         self._view_frame.canvash.draw()
 	
     def BarPlotwithData(self):
@@ -3228,7 +3731,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         idx_sagittal = self.slice_viewerS.ipws[1].GetSliceIndex()
         idx_coronal = self.slice_viewerC.ipws[2].GetSliceIndex()
 			
-        iso_object = Isovalue(self.nr_doseplans, self.doseplans, self.xmin, self.xmax, \
+        iso_object = Isovalue(self.stack, self.xmin, self.xmax, \
 							self.ymin, self.ymax, self.zmin, self.zmax, \
 							self.image_data50, self.image_data100)
         iso_object.initialize_pipeline()
@@ -3240,7 +3743,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         elif idx == 2:
             temp_ctf = self.ctf_blue
 		
-        for plan in range(len(self.planlist)):
+        for plan in range(self.nr_doseplans):
             probability = self.contours_info[dose][plan][1]
             color = temp_ctf.GetColor(probability)
             opacity = self.otf.GetValue(probability)
@@ -3302,7 +3805,7 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
             if dlg2.ShowModal() == wx.ID_OK:
                 ffilelist=dlg2.GetPaths()
                 self._config.last_used_dir=dlg2.GetDirectory()
-                self.load_plan_from_file(ffilelist)
+                self.load_plan_from_file(ffilelist, self._ensemble_cache_path(full_file_path, ffilelist))
             dlg2.Destroy()
         dlg.Destroy()
 		
@@ -3319,26 +3822,16 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
 					
 					
     def create_mean_std_file(self, file):
-        voxel_values = {}
-        self.coordinates = []
-        print("printing mean")
+        """ Build the voxel table (coordinates, mean, std and plan count) that feeds the scatterplot """
 		
         if file == "pb_ano1.vti":
-            for z, y, x in product(range(55,85), range(45,75), range(75,115)):
-                if self.planlist[0].GetScalarComponentAsDouble(x, y, z, 0) <> 0 and self.planlist[1].GetScalarComponentAsDouble(x, y, z, 0) <> 0 and self.planlist[2].GetScalarComponentAsDouble(x, y, z, 0) <> 0:
-                    voxels = [self.planlist[j].GetScalarComponentAsDouble(x, y, z, 0) for j in range(1, len(self.planlist))]
-                    voxel_values[x, y, z] = [np.mean(voxels),np.std(voxels)]
-                    self.coordinates.append([x,y,z])
-                    self.meanx.append(np.mean(voxels))
-                    self.stdy.append(np.std(voxels))
+            #Region of interest of the anonymized patient, the Y-axis of the plans is stored flipped
+            flip_y = self.stack.ny - 1
+            bounds = (75, 115, flip_y - 74, flip_y - 44, 55, 85)
         else:
-            for z, y, x in product(range(self.zmin,self.zmax+1), range(self.ymin,self.ymax+1), range(self.xmin,self.xmax+1)):
-                if self.planlist[0].GetScalarComponentAsDouble(x, y, z, 0) <> 0 and self.planlist[1].GetScalarComponentAsDouble(x, y, z, 0) <> 0 and self.planlist[2].GetScalarComponentAsDouble(x, y, z, 0) <> 0:
-                    voxels = [self.planlist[j].GetScalarComponentAsDouble(x, y, z, 0) for j in range(1, len(self.planlist))]
-                    voxel_values[x, y, z] = [np.mean(voxels),np.std(voxels)]
-                    self.coordinates.append([x,y,z])
-                    self.meanx.append(np.mean(voxels))
-                    self.stdy.append(np.std(voxels))
+            bounds = (self.xmin, self.xmax + 1, self.ymin, self.ymax + 1, self.zmin, self.zmax + 1)
+			
+        self.voxel_table = VoxelTable(self.stack.data, self.statistics, bounds)
 		
 		
     def _pick_event(self, event, obj):
@@ -3384,10 +3877,240 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf.text_overlay.Enable(False)
         vf.show_overlay.Enable(False)
         vf.text_colormap.Enable(False)
-        vf.radio_mean.Enable(False)
-        vf.text_radio_mean.Enable(False)
-        vf.radio_std.Enable(False)
-        vf.text_radio_std.Enable(False)
+        vf.colormap_choice.Enable(False)
+        vf.probability_spin.Enable(False)
+			
+    def _handler_load_structures(self, event):
+        """Event handler for when the user selects Analysis -> Load Structures from
+        the main menu. The label volume has to be on the grid of the dose plans.
+        """
+        if self.stack is None:
+            self._view_frame.SetStatusText("Load the dose plans of a patient before its structures")
+            return
+			
+        filters = 'Label volume (*.vti)|*.vti;'
+        dlg = wx.FileDialog(self._view_frame, "Please choose the label volume of the structures", self._config.last_used_dir, "", filters, wx.OPEN)
+        if dlg.ShowModal() == wx.ID_OK:
+            file_path = dlg.GetPath()
+            labels = read_plan(file_path)[0].astype(np.int32)
+			
+            if labels.shape != self.stack.shape:
+                self._view_frame.SetStatusText("The label volume %s is not on the grid of the dose plans" % (file_path))
+            else:
+                self.structures[self.item] = (file_path, labels)
+                self._handler_dvh(None)
+        dlg.Destroy()
+		
+    def _handler_dvh(self, event):
+        """Event handler for when the user selects Analysis -> Dose Volume Histograms from
+        the main menu.
+        """
+        if self.stack is None or self.item not in self.structures:
+            self._view_frame.SetStatusText("Load the dose plans and the structures of a patient first")
+            return
+			
+        vf = self._view_frame
+        vf._mgr.GetPane("dvh").Show()
+        vf._mgr.Update()
+		
+        self.plot_dvh(self.dose_volume_histograms())
+        self.plot_roi_table(vf.roi_metric_choice.GetValue())
+		
+    def OnROIMetric(self, event):
+        if self.stack is not None and self.item in self.structures:
+            self.plot_roi_table(self._view_frame.roi_metric_choice.GetValue())
+		
+    def _structures_key(self):
+        """ Cache key and engine options for the structures of the current patient and the included plans """
+		
+        file_path, labels = self.structures[self.item]
+        options = self._ensemble_engine_options()
+		
+        plans = options.get('plans', np.arange(self.nr_doseplans))
+        return (self.item, file_path, tuple(plans)), labels, options
+		
+    def structure_statistics(self):
+        """ The table with the statistics of every (included) plan per structure of the current patient, cached per patient """
+		
+        key, labels, options = self._structures_key()
+		
+        if key not in self.roi_cache:
+            self._view_frame.SetStatusText("Computing the statistics of the structures...")
+            self.roi_cache[key] = ROITable(self.stack.data, labels, **options).compute()
+			
+        return self.roi_cache[key]
+		
+    def plot_roi_table(self, metric):
+        """ Draw the structure statistic of every plan as a heatmap of plans x structures """
+		
+        roi = self.structure_statistics()
+        plans = self._structures_key()[0][2]
+        self.roi_info = roi.info(metric, plans)
+		
+        rows = []
+        for label, values in self.roi_info.items():
+            for plan, value in values:
+                rows.append({'Doseplans': 'DP ' + str(plan), 'Structure': 'Structure %d' % (label), metric: value})
+				
+        ax = self._view_frame.ax_roi
+        ax.cla()
+        if rows:
+            table = pd.DataFrame(rows).pivot("Doseplans", "Structure", metric)
+            g = sns.heatmap(table, ax = ax, cbar = False, annot = False, cmap = sns.light_palette("#4d4d4d", as_cmap=True))
+            for item in g.get_yticklabels():
+                item.set_rotation(0)
+        ax.set_title(metric + " (Gy)")
+		
+        self._view_frame.canvas_dvh.draw()
+		
+    def dose_volume_histograms(self):
+        """ The DVHs of the (included) plans for the structures of the current patient, cached per patient """
+		
+        key, labels, options = self._structures_key()
+		
+        if key not in self.dvh_cache:
+            self._view_frame.SetStatusText("Computing the dose volume histograms...")
+            max_dose = np.ceil(np.max(self.statistics.maximum))
+            self.dvh_cache[key] = EnsembleDVH(self.stack.data, labels, max_dose, self._config.dvh_bin_width, **options).compute()
+            self._view_frame.SetStatusText("Computed the dose volume histograms of %d structures" % (len(self.dvh_cache[key].labels)))
+			
+        return self.dvh_cache[key]
+		
+    def plot_dvh(self, dvh):
+        """ Draw the DVH of every plan, with the median and the min-max band, for every structure """
+		
+        ax = self._view_frame.ax_dvh
+        ax.cla()
+        ax.set_xlabel("Dose (Gy)")
+        ax.set_ylabel("Volume (%)")
+		
+        doses = dvh.doses
+        colors = sns.color_palette("husl", len(dvh.labels))
+		
+        for structure, label in enumerate(dvh.labels):
+            color = colors[structure]
+            for plan in dvh.dvh[structure]:
+                ax.plot(doses, plan * 100, color=color, alpha=0.15, lw=0.5)
+				
+            minimum, median, maximum = dvh.bands(structure)
+            ax.fill_between(doses, minimum * 100, maximum * 100, color=color, alpha=0.25)
+            ax.plot(doses, median * 100, color=color, lw=2, label="Structure %d" % (label))
+			
+        ax.set_ylim(0, 105)
+        ax.legend(loc="upper right")
+        self._view_frame.canvas_dvh.draw()
+		
+    def _handler_cluster_plans(self, event):
+        """Event handler for when the user selects Analysis -> Cluster Dose Plans from
+        the main menu.
+        """
+        if self.stack is None:
+            self._view_frame.SetStatusText("Load the dose plans of a patient before clustering them")
+            return
+			
+        self.cluster_plans()
+        self._view_frame.canvash.draw()
+		
+    def _handler_gamma(self, event):
+        """Event handler for when the user selects Analysis -> Gamma Analysis from
+        the main menu.
+        """
+        if self.stack is None:
+            self._view_frame.SetStatusText("Load the dose plans of a patient before the gamma analysis")
+            return
+			
+        vf = self._view_frame
+        choices = ['Mean dose plan'] + ['DP %d: %s' % (plan, vf.plan_list.GetItem(plan, 1).GetText()) for plan in range(self.nr_doseplans)]
+        dlg = wx.SingleChoiceDialog(vf, "Compare the dose plans with", "Gamma analysis reference", choices)
+        if dlg.ShowModal() == wx.ID_OK:
+            selection = dlg.GetSelection()
+            self.gamma_analysis(None if selection == 0 else selection - 1)
+            if vf.colormap_choice.GetValue() == 'Gamma Index':
+                self.OnColorMap(event)
+        dlg.Destroy()
+		
+    def _handler_influence(self, event):
+        """Event handler for when the user selects Analysis -> Leave-One-Out Influence from
+        the main menu.
+        """
+        if self.stack is None:
+            self._view_frame.SetStatusText("Load the dose plans of a patient before computing their influence")
+            return
+			
+        try:
+            influence = self.leave_one_out_influence()
+        except ValueError as e:
+            self._view_frame.SetStatusText(str(e))
+            return
+			
+        if self.contours_info:
+            self.heatMap()
+			
+        plan = self.influence_plans[int(np.argmax(influence.std_change))]
+        self._view_frame.SetStatusText("Leaving out DP %d changes the std the most: %.2f Gy (RMS), at most %.2f Gy" %
+                                       (plan, np.max(influence.std_change), influence.max_std_change[self.influence_plans.index(plan)]))
+		
+    def plan_distances(self):
+        """ The distance matrix of the (included) plans of the current patient in the dose region, cached per patient """
+		
+        options = self._ensemble_engine_options()
+        plans = options.get('plans', np.arange(self.nr_doseplans))
+        key = (self.item, self._config.plan_distance, tuple(plans))
+		
+        if key not in self.distance_cache:
+            self._view_frame.SetStatusText("Computing the distances between the dose plans...")
+            mask = self.statistics.nonzero_count > 0
+            self.distance_cache[key] = PlanDistances(self.stack.data, self._config.plan_distance, mask, **options).compute()
+			
+        return plans, self.distance_cache[key]
+		
+    def cluster_plans(self):
+        """ Cluster the (included) plans on their distances and color them by cluster in the plan list and the heatmap """
+		
+        plans, distances = self.plan_distances()
+		
+        if self._config.cluster_method == 'hierarchical':
+            clusters, medoids = hierarchical_clusters(distances.distances, self._config.nr_clusters)
+        else:
+            clusters, medoids = k_medoids(distances.distances, self._config.nr_clusters)
+			
+        self.plan_clusters = {}
+        for i, plan in enumerate(plans):
+            self.plan_clusters[plan] = (clusters[i], i in medoids)
+			
+        plan_list = self._view_frame.plan_list
+        colors = self._cluster_colors()
+        for plan in range(self.nr_doseplans):
+            item = plan_list.GetItem(plan, 3)
+            if plan in self.plan_clusters:
+                cluster, medoid = self.plan_clusters[plan]
+                item.SetText("%d%s" % (cluster + 1, " (representative)" if medoid else ""))
+                item.SetTextColour(wx.Colour(*[int(c * 255) for c in colors[cluster]]))
+            else:
+                item.SetText("")
+            plan_list.SetItem(item)
+			
+        self.color_heatmap_clusters()
+        self._view_frame.SetStatusText("Clustered %d dose plans in %d groups" % (len(plans), len(medoids)))
+		
+    def _cluster_colors(self):
+        nr_clusters = max([cluster for cluster, medoid in self.plan_clusters.values()] or [0]) + 1
+        return sns.color_palette("husl", nr_clusters)
+		
+    def color_heatmap_clusters(self):
+        """ Color the dose plan labels of the heatmap by cluster, the representative plans in bold """
+		
+        if not self.plan_clusters:
+            return
+			
+        colors = self._cluster_colors()
+        for item in self._view_frame.axh.get_yticklabels():
+            match = re.match(r"DP (\d+)$", item.get_text())
+            if match is None or int(match.group(1)) not in self.plan_clusters:
+                continue
+            cluster, medoid = self.plan_clusters[int(match.group(1))]
+            item.set_color(colors[cluster])
+            item.set_weight('bold' if medoid else 'normal')
 			
     def _handler_voxel_view(self,event):
         """Event handler for when the user selects View -> Voxel Uncertainty view
@@ -3405,10 +4128,8 @@ class EnsembleViewer(IntrospectModuleMixin, ModuleBase):
         vf.text_overlay.Enable(True)
         vf.show_overlay.Enable(True)
         vf.text_colormap.Enable(True)
-        vf.radio_mean.Enable(True)
-        vf.text_radio_mean.Enable(True)
-        vf.radio_std.Enable(True)
-        vf.text_radio_std.Enable(True)
+        vf.colormap_choice.Enable(True)
+        vf.probability_spin.Enable(True)
 			
 		
     def render(self):
@@ -85,6 +85,29 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
 
         self.menubar.Append(views_menu, "&Views")
 		
+        analysis_menu = wx.Menu()
+        self.analysis_structures_id = wx.NewId()
+        analysis_menu.Append(self.analysis_structures_id, "Load &Structures...\tCtrl-L",
+                         "Load a label volume with the structures of the patient.", wx.ITEM_NORMAL)
+						 
+        self.analysis_dvh_id = wx.NewId()
+        analysis_menu.Append(self.analysis_dvh_id, "&Dose Volume Histograms\tCtrl-H",
+                         "Show the dose volume histograms of the structures for all dose plans.", wx.ITEM_NORMAL)
+						 
+        self.analysis_clusters_id = wx.NewId()
+        analysis_menu.Append(self.analysis_clusters_id, "&Cluster Dose Plans\tCtrl-K",
+                         "Group the dose plans by their dose distances and mark a representative plan per group.", wx.ITEM_NORMAL)
+						 
+        self.analysis_gamma_id = wx.NewId()
+        analysis_menu.Append(self.analysis_gamma_id, "&Gamma Analysis...\tCtrl-G",
+                         "Compare every dose plan with the mean plan or a reference plan using the gamma index.", wx.ITEM_NORMAL)
+						 
+        self.analysis_influence_id = wx.NewId()
+        analysis_menu.Append(self.analysis_influence_id, "Leave-One-Out &Influence\tCtrl-I",
+                         "Show how much the mean and std change when leaving out each dose plan.", wx.ITEM_NORMAL)
+						 
+        self.menubar.Append(analysis_menu, "&Analysis")
+		
 		
         help_menu = wx.Menu()
         help_about_id = wx.NewId()
@@ -158,6 +181,12 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
                           Bottom().
                           BestSize(wx.Size(1000,800)).
                           MinimizeButton(True).MaximizeButton(True))
+						  
+        self._mgr.AddPane(self._create_dvh_pane(), wx.aui.AuiPaneInfo().
+                          Name("dvh").Caption("Dose Volume Histograms").
+                          Bottom().
+                          BestSize(wx.Size(1000,800)).
+                          MinimizeButton(True).MaximizeButton(True))
 		
 
         self.SetMinSize(wx.Size(400, 300))
@@ -169,6 +198,7 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self._mgr.GetPane("scatterplot").Hide()
         self._mgr.GetPane("3dview").Hide()
         self._mgr.GetPane("distplot").Hide()
+        self._mgr.GetPane("dvh").Hide()
         self._perspectives['default'] = self._mgr.SavePerspective()
 
         #------------- Show maximum image view ------------------#
@@ -186,6 +216,7 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self._mgr.GetPane("3dview").Hide()
         self._mgr.GetPane("scatterplot").Hide()
         self._mgr.GetPane("distplot").Hide()
+        self._mgr.GetPane("dvh").Hide()
         # save the perspective again
         self._perspectives['max_image'] = self._mgr.SavePerspective()
 
@@ -206,6 +237,7 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self._mgr.GetPane("3dview").Hide()
         self._mgr.GetPane("scatterplot").Hide()
         self._mgr.GetPane("distplot").Hide()
+        self._mgr.GetPane("dvh").Hide()
 		
         self._perspectives['contour_view'] = self._mgr.SavePerspective()
 		
@@ -227,6 +259,7 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self._mgr.GetPane("sagittal").Hide()
         self._mgr.GetPane("probs").Hide()
         self._mgr.GetPane("overview").Hide()
+        self._mgr.GetPane("dvh").Hide()
 		
         self._perspectives['voxel_view'] = self._mgr.SavePerspective()
 		
@@ -313,6 +346,21 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         self.static_line = wx.StaticLine(panel, wx.ID_ANY, wx.DefaultPosition, wx.DefaultSize, wx.LI_HORIZONTAL )
         bSizer.Add( self.static_line, 0, wx.EXPAND |wx.ALL, 5 )
 		
+		#Dose plans of the current patient, unchecked plans are left out of the statistics
+        self.plan_list = ulc.UltimateListCtrl(panel, agwStyle=wx.LC_REPORT | wx.BORDER_DEFAULT
+                                         | wx.LC_VRULES 
+                                         | wx.LC_HRULES
+                                         | ulc.ULC_HAS_VARIABLE_ROW_HEIGHT, size = ( -1,100 ))
+        
+        self.plan_list.InsertColumn(0, 'Include', format= ulc.ULC_FORMAT_CENTER, width = 75)
+        self.plan_list.InsertColumn(1, 'Dose Plan', format= ulc.ULC_FORMAT_LEFT, width = 300)
+        self.plan_list.InsertColumn(2, 'Mode Scores', format= ulc.ULC_FORMAT_LEFT, width = 200)
+        self.plan_list.InsertColumn(3, 'Cluster', format= ulc.ULC_FORMAT_LEFT, width = 120)
+        self.plan_list.InsertColumn(4, 'Gamma Pass (%)', format= ulc.ULC_FORMAT_RIGHT, width = 110)
+        self.plan_list.SetFont(font_columns)
+		
+        bSizer.Add( self.plan_list, 1, wx.ALL|wx.EXPAND, 5 )
+		
         panel.SetSizer(bSizer)
         bSizer.Fit(panel)
 		
@@ -363,10 +411,14 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
        self.show_overlay = wx.CheckBox(panel, wx.ID_ANY, wx.EmptyString, wx.DefaultPosition, wx.DefaultSize, 0 )	   
        self.show_overlay.SetValue(False)
 	   
-       self.text_colormap = wx.StaticText(panel, -1, "Mean " , wx.Point(0, 0))
-       self.radio_mean = wx.RadioButton(panel, wx.ID_ANY, label=' ', style=wx.RB_GROUP)
-       self.text_radio_mean = wx.StaticText(panel, -1, "STD  " , wx.Point(0, 0))
-       self.radio_std = wx.RadioButton(panel, wx.ID_ANY, label=' ')
+       self.text_colormap = wx.StaticText(panel, -1, "Colormap " , wx.Point(0, 0))
+       self.colormap_choice = wx.ComboBox(panel, wx.ID_ANY, value = 'Mean', size = (150, -1), style = wx.CB_READONLY,
+                                          choices = ['Mean', 'Standard Deviation', 'Median', 'Interquartile Range', 'P5', 'P25', 'P75', 'P95',
+                                                     'Isodose Probability', 'Mode 1', 'Mode 2', 'Mode 3',
+                                                     'Gamma Index', 'Mean CI Lower', 'Mean CI Upper', 'Mean CI Width',
+                                                     'Std CI Lower', 'Std CI Upper', 'Std CI Width',
+                                                     'Influence on Mean', 'Influence on Std'])
+       self.probability_spin = wx.SpinCtrl(panel, wx.ID_ANY, '70', wx.DefaultPosition, wx.Size( 60,-1 ), wx.SP_ARROW_KEYS, 70, 93, 70)
 	   
        button_sizer = wx.BoxSizer(wx.HORIZONTAL)
        button_sizer.AddSpacer(30)
@@ -384,9 +436,8 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
        button_sizer.Add(self.show_overlay)
        button_sizer.AddSpacer(15)
        button_sizer.Add(self.text_colormap)
-       button_sizer.Add(self.radio_mean)
-       button_sizer.Add(self.text_radio_mean)
-       button_sizer.Add(self.radio_std)
+       button_sizer.Add(self.colormap_choice)
+       button_sizer.Add(self.probability_spin)
 	   
        button_sizer.AddSpacer(30)
 	   
@@ -512,6 +563,42 @@ class EnsembleViewerFrame(wx.Frame, wx.lib.mixins.listctrl.ColumnSorterMixin):
         return panel
 		
 		
+    def _create_dvh_pane(self):
+        """Create a plot for the dose volume histograms of the structures over the ensemble
+        """
+        panel = wx.Panel(self, -1)
+		
+        self.fig_dvh = Figure()
+        self.ax_dvh = self.fig_dvh.add_subplot(121)
+        self.ax_dvh.set_xlabel("Dose (Gy)")
+        self.ax_dvh.set_ylabel("Volume (%)")
+		
+		#Statistics of every dose plan per structure
+        self.ax_roi = self.fig_dvh.add_subplot(122)
+		
+        self.canvas_dvh = FigureCanvas(panel, -1, self.fig_dvh)
+        self.toolbar_dvh = NavigationToolbar(self.canvas_dvh)
+		
+        self.text_roi_metric = wx.StaticText(panel, -1, "Structure statistic ", wx.Point(0, 0))
+        self.roi_metric_choice = wx.ComboBox(panel, wx.ID_ANY, value = 'D95', size = (100, -1), style = wx.CB_READONLY,
+                                             choices = ['Mean', 'Minimum', 'Maximum', 'D95', 'D2'])
+		
+        hbox = wx.BoxSizer(wx.HORIZONTAL)
+        hbox.Add(self.toolbar_dvh, 1, wx.EXPAND)
+        hbox.AddSpacer(15)
+        hbox.Add(self.text_roi_metric, 0, wx.ALIGN_CENTER_VERTICAL)
+        hbox.Add(self.roi_metric_choice, 0, wx.ALIGN_CENTER_VERTICAL)
+		
+        vbox = wx.BoxSizer(wx.VERTICAL)
+        vbox.Add(self.canvas_dvh, 1, wx.EXPAND|wx.BOTTOM, 7)
+        vbox.Add(hbox, 0, wx.EXPAND)
+		
+        panel.SetSizer(vbox)
+        vbox.Fit(panel)
+		
+        return panel
+		
+		
     def _create_distplot_pane(self):
         """Create a KDE plot for visualizing the distributions per voxel
         """
@@ -0,0 +1,460 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import collections
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import numpy as np
+import vtk
+
+from statistics_utils import SlabEngine
+
+
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """ The number of set bits in every row of a C-contiguous (rows, words) uint64 array"""
+    return POPCOUNT[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+class ContourBandDepth(SlabEngine):
+    """Class to compute the contour boxplot of the isodose contours of an ensemble of dose plans.
+
+	The contour of a plan at an isovalue is the region receiving at least that dose. Its band depth
+	is the fraction of the pairs of the other plans (j, k) whose band contains it: the intersection
+	of j and k lies inside the region and the region lies inside their union. A plan always lies in
+	the bands it bounds itself, so these N - 1 pairs are left out. With epsilon > 0 a fraction
+	epsilon of the voxels may violate either containment (the epsilon band depth).
+
+	Voxels inside (or outside) all the plans never violate a containment, so only the voxels where
+	the plans disagree are kept. One pass over the slabs stores, for every isovalue, the membership
+	of every plan in these voxels as a bit-packed mask of 64-bit words. Every band is then tested
+	against all plans at once with vectorized AND/OR/NOT over the words, the violating voxels are
+	found with any() or counted with a byte popcount table. The pairs are spread over a thread pool.
+
+	The deepest contour is the median, the contours with depth 0 are the outliers. The 50% and
+	100% bands follow from this ranking, they are derived with isodose_band when they are shown.
+
+	Attributes:
+
+		- isovalues: a list with the isovalues in Gy.
+		- depths: a float array of shape (T, N) with the band depth of every plan at every isovalue.
+		- median: a dictionary mapping each isovalue to the index of its deepest plan.
+		- outliers: a dictionary mapping each isovalue to the list of plans with depth 0.
+	"""
+
+    ISOVALUES = range(70, 94)
+
+    def __init__(self, data, isovalues=ISOVALUES, epsilon=0.0, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None, plans=None):
+
+        self.isovalues = list(isovalues)
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.epsilon = epsilon
+        self.depths = None
+        self.median = {}
+        self.outliers = {}
+
+        # per slab and isovalue: the packed membership of the disagreeing voxels (padded to whole
+        # words) and the number of voxels inside all the plans
+        self._slabs = {}
+
+    def voxel_bytes(self):
+        # the slab values and the membership of one isovalue
+        return 5 * self.nr_doseplans
+
+    def compute_slab(self, z0, z1):
+        """ Pack the membership of every plan in the voxels where the plans disagree, for the planes z0 <= z < z1"""
+
+        block = self.slab(z0, z1).reshape(self.nr_doseplans, -1)
+        packed = []
+
+        for isovalue in self.isovalues:
+            inside = block >= isovalue
+            count = inside.sum(axis=0)
+            disagree = np.nonzero((count > 0) & (count < self.nr_doseplans))[0]
+            common = int(np.count_nonzero(count == self.nr_doseplans))
+
+            # pad the bits to whole words, the padding is outside every plan
+            nr_bits = (len(disagree) + 63) // 64 * 64
+            bits = np.zeros((self.nr_doseplans, nr_bits), dtype=bool)
+            bits[:, :len(disagree)] = inside[:, disagree]
+            packed.append((np.packbits(bits, axis=1).view(np.uint64), common))
+
+        self._slabs[z0] = packed
+
+    def _pair_counts(self, words, plan_sizes, common, j):
+        """ The number of bands (j, k > j) that contain each plan"""
+
+        contained = np.zeros(self.nr_doseplans, dtype=np.int64)
+        not_words = ~words
+
+        for k in range(j + 1, self.nr_doseplans):
+            intersection = words[j] & words[k]
+            union = words[j] | words[k]
+
+            # intersection voxels outside a plan, and plan voxels outside the union
+            missing = intersection & not_words
+            extra = words & ~union
+
+            if self.epsilon == 0:
+                contained += ~(missing.any(axis=1) | extra.any(axis=1))
+            else:
+                intersection_size = popcount(intersection[np.newaxis])[0] + common
+                contained += ((popcount(missing) <= self.epsilon * intersection_size) &
+                              (popcount(extra) <= self.epsilon * plan_sizes))
+        return contained
+
+    def compute(self):
+        SlabEngine.compute(self)
+
+        # the pairs of the other plans
+        nr_pairs = (self.nr_doseplans - 1) * (self.nr_doseplans - 2) // 2
+        self.depths = np.ones((len(self.isovalues), self.nr_doseplans))
+        pool = ThreadPool(max(1, min(self.workers, self.nr_doseplans - 1)))
+
+        try:
+            for t, isovalue in enumerate(self.isovalues):
+                slabs = [self._slabs[z0][t] for z0 in sorted(self._slabs)]
+                words = np.ascontiguousarray(np.concatenate([s[0] for s in slabs], axis=1))
+                common = sum(s[1] for s in slabs)
+                plan_sizes = popcount(words) + common
+
+                if nr_pairs > 0:
+                    counts = pool.map(lambda j: self._pair_counts(words, plan_sizes, common, j), range(self.nr_doseplans - 1))
+                    # every plan is contained in the N - 1 bands it bounds
+                    self.depths[t] = (np.sum(counts, axis=0) - (self.nr_doseplans - 1)) / nr_pairs
+
+                depths = self.depths[t]
+                order = np.argsort(-depths, kind='mergesort')
+                self.median[isovalue] = int(order[0])
+                self.outliers[isovalue] = [int(plan) for plan in np.nonzero(depths == 0)[0]]
+        finally:
+            pool.close()
+            pool.join()
+
+        self._slabs = {}
+        return self
+
+    def ranking(self, isovalue, plans=None):
+        """ The band depth of every plan at isovalue as {plan: depth}, the layout of the offline ranking files"""
+
+        if plans is None:
+            plans = range(self.nr_doseplans)
+        depths = self.depths[self.isovalues.index(isovalue)]
+        return dict((plan, depths[i]) for i, plan in enumerate(plans))
+
+
+class ModifiedBandDepth(SlabEngine):
+    """Class to compute the contour boxplot of the isodose contours of a large ensemble with the modified band depth.
+
+	The modified band depth of a plan is the fraction of the (pair of plans, voxel) combinations in
+	which the plan lies inside the band of the pair, over the voxels where the plans disagree. At a
+	voxel with m of the N plans inside the isodose region, a plan inside it lies in the band of
+	every pair with at least one plan inside, C(N, 2) - C(N - m, 2) pairs, and a plan outside it in
+	the C(N, 2) - C(m, 2) pairs with at least one plan outside. Ranking the two indicator values
+	of a voxel reduces to counting them, so the cost is O(N) per voxel instead of O(N^2) for the
+	pairwise band depth. The counts of all plans are one matrix-vector product per slab and isovalue.
+
+	The deepest contour is the median, the outliers are the contours whose depth lies below the lower
+	quartile of the depths by more than outlier_fence times the interquartile range. The bands
+	follow from the ranking like for ContourBandDepth.
+
+	Attributes:
+
+		- isovalues: a list with the isovalues in Gy.
+		- depths: a float array of shape (T, N) with the modified band depth of every plan at every isovalue.
+		- median: a dictionary mapping each isovalue to the index of its deepest plan.
+		- outliers: a dictionary mapping each isovalue to the list of outlying plans.
+	"""
+
+    ISOVALUES = ContourBandDepth.ISOVALUES
+
+    def __init__(self, data, isovalues=ISOVALUES, outlier_fence=1.5, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None, plans=None):
+
+        self.isovalues = list(isovalues)
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.outlier_fence = outlier_fence
+        self.depths = None
+        self.median = {}
+        self.outliers = {}
+
+        # the pair counts of every plan and the number of disagreeing voxels, both exact in double precision
+        self._totals = np.zeros((len(self.isovalues), self.nr_doseplans), dtype=np.float64)
+        self._nr_voxels = np.zeros(len(self.isovalues), dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def voxel_bytes(self):
+        # the slab values, the membership of one isovalue and its double precision copy
+        return 13 * self.nr_doseplans
+
+    def compute_slab(self, z0, z1):
+        n = self.nr_doseplans
+        pairs = n * (n - 1) // 2
+        block = self.slab(z0, z1).reshape(n, -1)
+        totals = np.zeros_like(self._totals)
+        nr_voxels = np.zeros_like(self._nr_voxels)
+
+        for t, isovalue in enumerate(self.isovalues):
+            inside = block >= isovalue
+            count = inside.sum(axis=0)
+            disagree = (count > 0) & (count < n)
+            inside = inside[:, disagree]
+            count = count[disagree].astype(np.float64)
+
+            # the pairs with a plan inside, and the pairs with a plan outside
+            with_inside = pairs - (n - count) * (n - count - 1) / 2
+            with_outside = pairs - count * (count - 1) / 2
+
+            totals[t] = np.dot(inside.astype(np.float64), with_inside - with_outside) + with_outside.sum()
+            nr_voxels[t] = len(count)
+
+        with self._lock:
+            self._totals += totals
+            self._nr_voxels += nr_voxels
+
+    def compute(self):
+        SlabEngine.compute(self)
+
+        pairs = self.nr_doseplans * (self.nr_doseplans - 1) // 2
+        self.depths = self._totals / np.maximum(self._nr_voxels * pairs, 1)[:, np.newaxis]
+        self.depths[self._nr_voxels == 0] = 1
+
+        for t, isovalue in enumerate(self.isovalues):
+            depths = self.depths[t]
+            order = np.argsort(-depths, kind='mergesort')
+            lower, upper = np.percentile(depths, [25, 75])
+            outliers = depths < lower - self.outlier_fence * (upper - lower)
+
+            self.median[isovalue] = int(order[0])
+            self.outliers[isovalue] = [int(plan) for plan in np.nonzero(outliers)[0]]
+
+        return self
+
+    def ranking(self, isovalue, plans=None):
+        """ The modified band depth of every plan at isovalue as {plan: depth}, the layout of the offline ranking files"""
+
+        if plans is None:
+            plans = range(self.nr_doseplans)
+        depths = self.depths[self.isovalues.index(isovalue)]
+        return dict((plan, depths[i]) for i, plan in enumerate(plans))
+
+
+def isovalues_boxplot(task):
+    """Compute the contour boxplots of a group of isovalues in one pass over the ensemble, the work item of a BoxplotPool.
+
+    task is a tuple (source, isovalues, method, epsilon, plans, cache_size). source is either the
+    (N, Z, Y, X) array, or a tuple (file name, offset, shape) of a memory-mapped float32 ensemble
+    that a worker process maps read-only. Returns a list with a tuple (isovalue, depths, median,
+    outliers) of plain values per isovalue, so that it can be handed back from a worker process.
+    """
+    source, isovalues, method, epsilon, plans, cache_size = task
+
+    if isinstance(source, tuple):
+        file_name, offset, shape = source
+        data = np.memmap(file_name, dtype=np.float32, mode='r', offset=offset, shape=shape)
+    else:
+        data = source
+
+    if method == 'modified':
+        engine = ModifiedBandDepth(data, isovalues, cache_size=cache_size, plans=plans)
+    else:
+        engine = ContourBandDepth(data, isovalues, epsilon, cache_size=cache_size, plans=plans)
+    engine.compute()
+
+    return [(isovalue, engine.depths[t], engine.median[isovalue], engine.outliers[isovalue])
+            for t, isovalue in enumerate(isovalues)]
+
+
+class BoxplotPool:
+    """Class to compute the contour boxplots of many isovalues concurrently.
+
+	The isovalues are independent, they are dealt out over one group per worker, and every
+	worker computes its group in a single pass over the ensemble, so the plans are read once per
+	worker rather than once per isovalue. In 'process' mode the groups run in a pool of worker processes that all memory-map the ensemble file read-only, so the
+	plans are shared through the page cache instead of being copied to every worker. An ensemble
+	that only lives in memory (not a memory-map) is shared by a pool of threads instead.
+
+	Attributes:
+
+		- workers: an integer representing the size of the worker pool (0 means one worker per core).
+		- mode: a string, either 'thread' or 'process', selecting the kind of worker pool.
+	"""
+
+    def __init__(self, workers=0, mode='process'):
+
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+
+        self.workers = workers
+        self.mode = mode
+
+    def imap(self, data, isovalues, method='exact', epsilon=0.0, plans=None, cache_size=2 * 1024 * 1024):
+        """ Generator over the (isovalue, depths, median, outliers) of every isovalue, a group at a time as the groups finish"""
+
+        isovalues = list(isovalues)
+        workers = max(1, min(self.workers, len(isovalues)))
+        if self.mode == 'process' and isinstance(data, np.memmap) and data.filename is not None:
+            source = (data.filename, data.offset, data.shape)
+            pool = multiprocessing.Pool(workers)
+        else:
+            source = data
+            pool = ThreadPool(workers)
+
+        # every worker gets the isovalues spread over the whole range, which keeps the groups equally costly
+        tasks = [(source, isovalues[i::workers], method, epsilon, plans, cache_size) for i in range(workers)]
+        try:
+            for results in pool.imap_unordered(isovalues_boxplot, tasks):
+                for result in results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+
+class BoxplotCache:
+    """Class to keep contour boxplot results on disk, addressed by the content they were computed from.
+
+	The key is a SHA-1 digest of the content digests of the plan files (file_digest, in ensemble
+	order, typically kept in the EnsembleCache so the files are not read again), the included
+	plans, the depth method and epsilon, and the isovalues, so a changed ensemble or changed
+	parameters never match a stale result, and the same plans give the same key on any machine.
+	Every result is one compressed .npz container named after its key, holding the depths and the
+	median and outlier ids of all isovalues. The bands are not stored, they follow from the ranking.
+
+	Attributes:
+
+		- directory: a string representing the directory the containers are kept in.
+	"""
+
+    VERSION = 'DVBOX003'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, digests, plans, method, epsilon, isovalues):
+        """ The hex digest addressing the boxplot of the plan files with the given content digests and parameters"""
+
+        digest = hashlib.sha1(self.VERSION)
+        for content in digests:
+            digest.update(content)
+
+        plans = range(len(digests)) if plans is None else plans
+        digest.update(repr(([int(plan) for plan in plans], method, float(epsilon), [int(iso) for iso in isovalues])))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.boxplot.npz" % (key))
+
+    def load(self, key):
+        """ The (isovalue, depths, median, outliers) of every cached isovalue, None when the key is not cached"""
+
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+
+        try:
+            container = np.load(path)
+            outliers = np.split(container['outliers'], container['outlier_offsets'][1:-1])
+
+            results = []
+            for t, isovalue in enumerate(container['isovalues']):
+                results.append((int(isovalue), container['depths'][t], int(container['medians'][t]),
+                                [int(plan) for plan in outliers[t]]))
+            container.close()
+        except Exception:
+            # an unreadable container is computed again
+            return None
+        return results
+
+    def save(self, key, results):
+        """ Store the (isovalue, depths, median, outliers) of every isovalue under key"""
+
+        results = sorted(results, key=lambda result: result[0])
+        outliers = [result[3] for result in results]
+        offsets = np.cumsum([0] + [len(o) for o in outliers])
+
+        arrays = {'isovalues': np.array([result[0] for result in results]),
+                  'depths': np.array([result[1] for result in results]),
+                  'medians': np.array([result[2] for result in results]),
+                  'outliers': np.array([plan for o in outliers for plan in o], dtype=np.int64),
+                  'outlier_offsets': offsets}
+
+        # written under a temporary name first, so that a container is either complete or missing
+        path = self.path(key)
+        temporary = path + '.%d.tmp' % (os.getpid())
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        if os.path.exists(path):
+            os.remove(temporary)
+        else:
+            os.rename(temporary, path)
+
+
+def isodose_band(data, isovalue, plans):
+    """ The (Z, Y, X) uint8 volume, 1 where the given plans disagree about receiving at least isovalue Gy"""
+
+    union = np.zeros(data.shape[1:], dtype=bool)
+    intersection = np.ones(data.shape[1:], dtype=bool)
+    if len(plans) < 2:
+        return union.view(np.uint8)
+
+    for plan in plans:
+        inside = data[plan] >= isovalue
+        union |= inside
+        intersection &= inside
+
+    union &= ~intersection
+    return union.view(np.uint8)
+
+
+class BandVolumes:
+    """Class to derive band volumes of the contour boxplot on demand, keeping the last ones in a small LRU cache.
+
+	Behaves like the dictionary from isovalue key to vtkImageData it replaces: looking up a key
+	asks band_plans(key) for the isovalue and the plans spanning the band, and builds the band
+	from the ensemble with isodose_band. The images own a copy of their scalars, so an image that
+	drops out of the cache stays valid for a viewer still showing it.
+
+	Attributes:
+
+		- stack: the EnsembleStack the bands are derived from.
+		- band_plans: a function mapping a key to a tuple (isovalue, plans).
+		- capacity: an integer representing the number of band volumes kept.
+	"""
+
+    def __init__(self, stack, band_plans, capacity=4):
+
+        self.stack = stack
+        self.band_plans = band_plans
+        self.capacity = max(1, capacity)
+        self._images = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        if key in self._images:
+            image = self._images.pop(key)
+        else:
+            isovalue, plans = self.band_plans(key)
+            image = vtk.vtkImageData()
+            image.DeepCopy(self.stack.volume_image(isodose_band(self.stack.data, isovalue, plans)))
+            if len(self._images) >= self.capacity:
+                self._images.popitem(last=False)
+
+        self._images[key] = image
+        return image
+
+    def clear(self):
+        """ Forget the cached bands, after the ranking they are derived from changed"""
+        self._images.clear()
@@ -0,0 +1,133 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import numpy as np
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+from modes_utils import GramMatrix
+
+
+class PlanDistances(GramMatrix):
+    """Class to compute the N x N matrix of dose distances between every pair of plans.
+
+	The 'l2' distance is the root mean square dose difference over the voxels. It follows from
+	the Gram matrix of the centred plans, |xi - xj|^2 = G[i, i] + G[j, j] - 2 G[i, j], so the
+	whole matrix costs one BLAS product per slab instead of a loop over the N^2 / 2 pairs.
+	The 'max' distance is the largest absolute dose difference, it has no such factorization
+	and is reduced per slab with one vectorized pass per plan against all the plans after it.
+	An optional (Z, Y, X) boolean mask restricts both distances to a region.
+
+	Attributes:
+
+		- metric: a string, either 'l2' or 'max'.
+		- distances: a float64 array of shape (N, N) with the distances in Gy.
+	"""
+
+    METRICS = ['l2', 'max']
+
+    def __init__(self, data, metric='l2', mask=None, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        if metric not in self.METRICS:
+            raise ValueError("Unknown plan distance %r, expected one of %s" % (metric, ", ".join(self.METRICS)))
+
+        self.metric = metric
+        GramMatrix.__init__(self, data, mask, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.distances = None
+
+    def voxel_bytes(self):
+        if self.metric == 'max':
+            # the slab values and the differences of one plan with the plans after it
+            return 8 * self.nr_doseplans
+        return GramMatrix.voxel_bytes(self)
+
+    def compute_slab(self, z0, z1):
+        if self.metric == 'l2':
+            GramMatrix.compute_slab(self, z0, z1)
+            return
+
+        block = self.slab(z0, z1).reshape(self.nr_doseplans, -1)
+        if self.mask is not None:
+            block = block[:, self.mask[z0:z1].ravel()]
+        if block.shape[1] == 0:
+            return
+
+        maximum = np.zeros((self.nr_doseplans, self.nr_doseplans), dtype=np.float64)
+        for i in range(self.nr_doseplans - 1):
+            maximum[i, i + 1:] = np.abs(block[i + 1:] - block[i]).max(axis=1)
+
+        with self._lock:
+            np.maximum(self.gram, maximum, out=self.gram)
+
+    def compute(self):
+        GramMatrix.compute(self)
+
+        if self.metric == 'l2':
+            diagonal = np.diag(self.gram)
+            squared = diagonal[:, np.newaxis] + diagonal[np.newaxis] - 2 * self.gram
+            self.distances = np.sqrt(np.maximum(squared, 0) / max(self.nr_voxels, 1))
+        else:
+            self.distances = self.gram + self.gram.T
+        np.fill_diagonal(self.distances, 0)
+
+        return self
+
+
+def k_medoids(distances, nr_clusters, max_iterations=100):
+    """ Partition the plans around nr_clusters medoids, returns the cluster of every plan and the medoids.
+
+    The medoids start from the most central plan followed by, repeatedly, the plan farthest from
+    the medoids so far, which makes the clustering deterministic. Every iteration assigns the plans
+    to their closest medoid and moves each medoid to the plan with the smallest total distance to
+    its cluster, until the medoids no longer change.
+    """
+    nr_plans = distances.shape[0]
+    nr_clusters = max(1, min(nr_clusters, nr_plans))
+
+    medoids = [int(np.argmin(distances.sum(axis=1)))]
+    while len(medoids) < nr_clusters:
+        medoids.append(int(np.argmax(distances[:, medoids].min(axis=1))))
+    medoids = np.array(medoids)
+
+    for iteration in range(max_iterations):
+        clusters = np.argmin(distances[:, medoids], axis=1)
+        # a medoid is always in its own cluster, also when it is as close to another medoid
+        clusters[medoids] = np.arange(nr_clusters)
+
+        new_medoids = medoids.copy()
+        for cluster in range(nr_clusters):
+            members = np.nonzero(clusters == cluster)[0]
+            new_medoids[cluster] = members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))]
+
+        if np.array_equal(new_medoids, medoids):
+            break
+        medoids = new_medoids
+
+    return clusters, medoids
+
+
+def hierarchical_clusters(distances, nr_clusters, method='average'):
+    """ Cut an agglomerative clustering of the plans into nr_clusters clusters, returns the cluster of every plan and the medoids"""
+
+    nr_plans = distances.shape[0]
+    nr_clusters = max(1, min(nr_clusters, nr_plans))
+    if nr_plans < 2:
+        return np.zeros(nr_plans, dtype=np.int64), np.zeros(nr_plans, dtype=np.int64)
+
+    linkage = hierarchy.linkage(squareform(distances, checks=False), method=method)
+    clusters = hierarchy.fcluster(linkage, nr_clusters, criterion='maxclust') - 1
+
+    # number the clusters from 0 and give each the plan closest to its other plans as representative
+    order, clusters = np.unique(clusters, return_inverse=True)
+    medoids = []
+    for cluster in range(len(order)):
+        members = np.nonzero(clusters == cluster)[0]
+        medoids.append(members[np.argmin(distances[np.ix_(members, members)].sum(axis=1))])
+
+    return clusters, np.array(medoids)
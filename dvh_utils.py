@@ -0,0 +1,179 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import threading
+import numpy as np
+
+from statistics_utils import SlabEngine
+
+
+class EnsembleDVH(SlabEngine):
+    """Class to compute the cumulative dose-volume histograms of every plan for the structures of a label volume.
+
+	The structures are the nonzero labels of a (Z, Y, X) label volume on the grid of the plans.
+	For every slab, the dose of all plans inside all structures is binned with a single
+	np.bincount over (structure, plan, dose bin), so all DVHs are built in one pass over the
+	ensemble. The slabs run in parallel, their integer counts are summed under a lock.
+
+	Attributes:
+
+		- labels: an int array of shape (S,) with the label of every structure.
+		- volumes: an int array of shape (S,) with the number of voxels of every structure.
+		- edges: a float array of shape (B + 1,) with the edges of the dose bins.
+		- counts: an int64 array of shape (S, N, B) with the number of voxels of a structure per dose bin and plan.
+		- dvh: a float array of shape (S, N, B), the fraction of a structure receiving at least edges[b] in each plan.
+	"""
+
+    def __init__(self, data, label_volume, max_dose, bin_width=0.5, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None, plans=None):
+
+        self.bin_width = bin_width
+        self.edges = np.arange(0, max_dose + bin_width, bin_width, dtype=np.float64)
+        if len(self.edges) < 2:
+            self.edges = np.array([0, bin_width], dtype=np.float64)
+        self.nr_bins = len(self.edges) - 1
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.label_volume = label_volume
+        self.labels = np.unique(label_volume[label_volume > 0])
+        self.volumes = np.array([np.count_nonzero(label_volume == label) for label in self.labels])
+
+        self.counts = np.zeros((len(self.labels), self.nr_doseplans, self.nr_bins), dtype=np.int64)
+        self.dvh = None
+        self._lock = threading.Lock()
+
+    def voxel_bytes(self):
+        # the slab values and their bin indices
+        return 12 * self.nr_doseplans
+
+    def compute_slab(self, z0, z1):
+        """ Bin the dose of all plans inside the structures for the planes z0 <= z < z1"""
+
+        labels = self.label_volume[z0:z1].ravel()
+        inside = labels > 0
+        if not inside.any():
+            return
+
+        structures = np.searchsorted(self.labels, labels[inside])
+        values = self.slab(z0, z1).reshape(self.nr_doseplans, -1)[:, inside]
+
+        bins = (values / self.bin_width).astype(np.int64)
+        np.clip(bins, 0, self.nr_bins - 1, out=bins)
+        bins += (structures[np.newaxis] * self.nr_doseplans + np.arange(self.nr_doseplans)[:, np.newaxis]) * self.nr_bins
+
+        counts = np.bincount(bins.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+        with self._lock:
+            self.counts += counts
+
+    def compute(self):
+        SlabEngine.compute(self)
+
+        # the voxels at or above each bin are the ones in that bin and the bins above it
+        cumulative = np.cumsum(self.counts[:, :, ::-1], axis=2)[:, :, ::-1]
+        self.dvh = cumulative / np.maximum(self.volumes, 1)[:, np.newaxis, np.newaxis]
+        return self
+
+    @property
+    def doses(self):
+        """ The doses (lower bin edges) the DVH fractions are given at"""
+        return self.edges[:-1]
+
+    def bands(self, structure):
+        """ The minimum, median and maximum DVH over the plans for the structure with index structure"""
+        dvh = self.dvh[structure]
+        return dvh.min(axis=0), np.median(dvh, axis=0), dvh.max(axis=0)
+
+
+class ROITable(SlabEngine):
+    """Class to compute dose statistics of every plan for every structure of a label volume.
+
+	The voxels of all structures are gathered from the ensemble slab by slab into one
+	(N, voxels) block, ordered by label once with a stable sort. Each structure is then a
+	contiguous run of columns, so the mean, minimum and maximum of every plan and structure come
+	from single np.add/minimum/maximum.reduceat calls, and D95/D2 from one partial selection
+	per structure (np.percentile).
+
+	D95 is the dose received by at least 95% of the structure (the 5th percentile of its voxel
+	doses), D2 the dose received by the hottest 2% (the 98th percentile).
+
+	The slabs are streamed like in the other engines, but the gathered (N, structure voxels) block
+	is held in memory until compute() returns. The table is in-core only: memory_budget bounds the
+	slabs, not this block.
+
+	Attributes:
+
+		- labels: an int array of shape (S,) with the label of every structure.
+		- volumes: an int array of shape (S,) with the number of voxels of every structure.
+		- table: a dictionary mapping each name in METRICS to a float array of shape (N, S).
+	"""
+
+    METRICS = ['Mean', 'Minimum', 'Maximum', 'D95', 'D2']
+
+    def __init__(self, data, label_volume, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.label_volume = label_volume
+        inside = label_volume > 0
+        voxel_labels = label_volume[inside]
+
+        self.labels, self.volumes = np.unique(voxel_labels, return_counts=True)
+        self.table = {}
+
+        # the columns of the voxels in the planes z0 <= z < z1 are _plane_columns[z0]:_plane_columns[z1]
+        self._plane_columns = np.concatenate(([0], np.cumsum(inside.reshape(inside.shape[0], -1).sum(axis=1))))
+        self._order = np.argsort(voxel_labels, kind='mergesort')
+        self._values = np.empty((self.nr_doseplans, len(voxel_labels)), dtype=np.float32)
+
+    def voxel_bytes(self):
+        return 4 * self.nr_doseplans
+
+    def compute_slab(self, z0, z1):
+        """ Gather the dose of all plans in the structure voxels of the planes z0 <= z < z1"""
+
+        column0, column1 = self._plane_columns[z0], self._plane_columns[z1]
+        if column0 == column1:
+            return
+
+        inside = self.label_volume[z0:z1].ravel() > 0
+        self._values[:, column0:column1] = self.slab(z0, z1).reshape(self.nr_doseplans, -1)[:, inside]
+
+    def compute(self):
+        SlabEngine.compute(self)
+
+        values = self._values[:, self._order]
+        del self._values
+        if len(self.labels) == 0:
+            for metric in self.METRICS:
+                self.table[metric] = np.empty((self.nr_doseplans, 0))
+            return self
+
+        starts = np.concatenate(([0], np.cumsum(self.volumes)[:-1]))
+
+        self.table['Mean'] = np.add.reduceat(values, starts, axis=1, dtype=np.float64) / self.volumes
+        self.table['Minimum'] = np.minimum.reduceat(values, starts, axis=1).astype(np.float64)
+        self.table['Maximum'] = np.maximum.reduceat(values, starts, axis=1).astype(np.float64)
+
+        d95 = np.empty((self.nr_doseplans, len(self.labels)))
+        d2 = np.empty((self.nr_doseplans, len(self.labels)))
+        for structure, (start, volume) in enumerate(zip(starts, self.volumes)):
+            d95[:, structure], d2[:, structure] = np.percentile(values[:, start:start + volume], [5, 98], axis=1)
+        self.table['D95'] = d95
+        self.table['D2'] = d2
+
+        return self
+
+    def info(self, metric, plans=None):
+        """ The metric per structure as {label: [[plan, value], ...]}, the layout of contours_info"""
+
+        if plans is None:
+            plans = range(self.nr_doseplans)
+        values = self.table[metric]
+        return dict((label, [[plan, values[i, structure]] for i, plan in enumerate(plans)])
+                    for structure, label in enumerate(self.labels))
@@ -0,0 +1,294 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import os
+import pickle
+import struct
+import vtk
+from vtk.util import numpy_support
+
+
+def read_plan(file_path):
+    """Decode a single dose plan VTI file.
+
+    Returns a tuple (scalars, spacing, origin, extent) where scalars is a
+    (Z, Y, X) numpy array owning its memory, so that it can be handed back
+    from a worker thread or process.
+    """
+    reader = vtk.vtkXMLImageDataReader()
+    reader.SetFileName(file_path)
+    reader.GetOutput().SetUpdateExtentToWholeExtent()
+    reader.Update()
+
+    image = reader.GetOutput()
+    ext = image.GetExtent()
+    shape = (ext[5] - ext[4] + 1, ext[3] - ext[2] + 1, ext[1] - ext[0] + 1)
+
+    scalars = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    scalars = np.array(scalars, copy=True).reshape(shape)
+
+    return scalars, image.GetSpacing(), image.GetOrigin(), ext
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """ The SHA-1 hex digest of the bytes of a file, read in chunks of chunk_size bytes"""
+
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def array_to_image(array, spacing, origin=(0, 0, 0), extent=None):
+    """Wrap a C-contiguous (Z, Y, X) array as vtkImageData without copying the scalars.
+
+    The caller has to keep a reference to the array for as long as the image is used.
+    """
+    if extent is None:
+        extent = (0, array.shape[2] - 1, 0, array.shape[1] - 1, 0, array.shape[0] - 1)
+
+    scalars = numpy_support.numpy_to_vtk(array.ravel(), deep=0)
+
+    image = vtk.vtkImageData()
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetExtent(extent)
+    image.SetWholeExtent(extent)
+    image.SetUpdateExtentToWholeExtent()
+    image.SetNumberOfScalarComponents(1)
+    image.SetScalarType(scalars.GetDataType())
+    image.GetPointData().SetScalars(scalars)
+
+    return image
+
+
+class PlanLoader:
+    """Class to decode the dose plans of an ensemble concurrently.
+
+	Attributes:
+
+		- workers: an integer representing the size of the worker pool (0 means one worker per core).
+		- mode: a string, either 'thread' or 'process', selecting the kind of worker pool.
+
+	The plans are always returned in the order of the file list, whatever the order in
+	which the workers finish them. The VTK 5 XML reader keeps the GIL while it parses, so
+	'thread' workers decode one plan at a time; 'process' workers run in parallel and hand
+	back the owned, picklable arrays of read_plan.
+	"""
+
+    def __init__(self, workers=0, mode='process'):
+
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+
+        self.workers = workers
+        self.mode = mode
+
+    def _create_pool(self, nr_files):
+        workers = max(1, min(self.workers, nr_files))
+        if self.mode == 'process':
+            return multiprocessing.Pool(workers)
+        return ThreadPool(workers)
+
+    def imap(self, filelist, callback=None):
+        """ Generator over the decoded plans of filelist, calling callback(index, file_path, plan) as each plan becomes available"""
+
+        pool = self._create_pool(len(filelist))
+
+        try:
+            for i, plan in enumerate(pool.imap(read_plan, filelist)):
+                if callback is not None:
+                    callback(i, filelist[i], plan)
+                yield plan
+        finally:
+            pool.close()
+            pool.join()
+
+    def load(self, filelist, callback=None):
+        """ Decode every file in filelist and return the plans as a list"""
+        return list(self.imap(filelist, callback))
+
+
+class EnsembleCache:
+    """Class to keep a binary copy of the dose plans of a patient on disk.
+	
+	The first time a patient is loaded the plans are decoded once and written as one contiguous
+	float32 (N, Z, Y, X) stack, starting at a page aligned offset after a small header holding
+	the spacing, origin, extent and the size/modification time and content digest of every plan
+	file. Later loads memory-map the stack instead of parsing the XML files, so only the touched
+	pages are read, and reuse the digests for as long as the sizes and modification times match.
+	
+	Attributes:
+	
+		- path: a string representing the location of the cache file.
+	"""
+
+    MAGIC = 'DVENS002'
+    PAGE_SIZE = 4096
+
+    def __init__(self, path):
+        self.path = path
+
+    def _file_stats(self, filelist):
+        stats = []
+        for file_path in filelist:
+            st = os.stat(file_path)
+            stats.append((os.path.abspath(file_path), st.st_size, st.st_mtime))
+        return stats
+
+    def _read_header(self):
+        with open(self.path, 'rb') as f:
+            head = f.read(24)
+            if len(head) < 24 or head[:8] != self.MAGIC:
+                return None, None
+            data_offset, meta_length = struct.unpack('<QQ', head[8:])
+            meta = pickle.loads(f.read(meta_length))
+        return data_offset, meta
+
+    def is_valid(self, filelist):
+        """ Check whether the cache exists and was built from the current version of filelist"""
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            data_offset, meta = self._read_header()
+        except Exception:
+            return False
+        if meta is None:
+            return False
+        try:
+            return meta['files'] == self._file_stats(filelist)
+        except OSError:
+            return False
+
+    def build(self, filelist, loader, callback=None):
+        """ Decode the plans in filelist with loader and stream them into the cache file"""
+
+        if len(filelist) == 0:
+            raise ValueError("An ensemble cache needs at least one dose plan")
+
+        stack = None
+        meta = {'files': self._file_stats(filelist), 'digests': [file_digest(f) for f in filelist]}
+
+        for i, (scalars, spacing, origin, extent) in enumerate(loader.imap(filelist, callback)):
+            if stack is None:
+                meta.update({'shape': (len(filelist),) + scalars.shape, 'spacing': spacing,
+                             'origin': origin, 'extent': extent})
+                meta_string = pickle.dumps(meta, 2)
+                data_offset = (24 + len(meta_string) + self.PAGE_SIZE - 1) // self.PAGE_SIZE * self.PAGE_SIZE
+                stack = np.memmap(self.path, dtype=np.float32, mode='w+', offset=data_offset, shape=meta['shape'])
+            stack[i] = scalars
+
+        stack.flush()
+        del stack
+
+        # the header is written last, so an interrupted build never looks like a valid cache
+        with open(self.path, 'r+b') as f:
+            f.write(self.MAGIC + struct.pack('<QQ', data_offset, len(meta_string)))
+            f.write(meta_string)
+
+    def open(self):
+        """ Memory-map the stack, returns the (N, Z, Y, X) array and the metadata dictionary"""
+        data_offset, meta = self._read_header()
+        stack = np.memmap(self.path, dtype=np.float32, mode='c', offset=data_offset, shape=meta['shape'])
+        return stack, meta
+
+    def read_slab(self, z0, z1):
+        """ Read the planes z0 <= z < z1 of every plan with plain file reads into a new (N, z1 - z0, Y, X) array.
+
+        Unlike slicing the memory-map, the pages read this way do not stay mapped in the process.
+        """
+        data_offset, meta = self._read_header()
+        nr_plans, nz, ny, nx = meta['shape']
+        plane_bytes = ny * nx * 4
+
+        slab = np.empty((nr_plans, z1 - z0, ny, nx), dtype=np.float32)
+        with open(self.path, 'rb') as f:
+            for i in range(nr_plans):
+                f.seek(data_offset + (i * nz + z0) * plane_bytes)
+                slab[i] = np.fromfile(f, dtype=np.float32, count=(z1 - z0) * ny * nx).reshape(slab.shape[1:])
+        return slab
+
+
+class EnsembleStack:
+    """Class to hold the dose plans of an ensemble as one contiguous (N, Z, Y, X) float32 array.
+	
+	Every consumer (statistics, contours, probing) reads from the same block of memory. The VTK
+	images handed out for a plan or a slice are views on that block, no scalars are copied.
+	
+	A stack opened from an EnsembleCache runs out-of-core: data is a memory-map, so the viewers
+	only page in the plans and slices they display, and read_slab streams whole z-slabs from the
+	cache file so that the statistics never need the ensemble in memory.
+	
+	Attributes:
+	
+		- data: a numpy array (or memory-map) of shape (N, Z, Y, X) holding the dose values.
+		- cache: the EnsembleCache backing an out-of-core stack, None for an in-memory stack.
+		- nr_doseplans: an integer representing the number of dose plans in the ensemble.
+		- spacing: a tuple representing the voxel spacing of the plans.
+		- extent: a tuple representing the VTK extent of a plan (always starting at the origin).
+	"""
+
+    def __init__(self, data, spacing, cache=None):
+
+        self.data = data
+        self.spacing = spacing
+        self.cache = cache
+        self.origin = (0.0, 0.0, 0.0)
+
+        self.nr_doseplans, self.nz, self.ny, self.nx = data.shape
+        self.extent = (0, self.nx - 1, 0, self.ny - 1, 0, self.nz - 1)
+
+        self._plan_images = {}
+
+    @classmethod
+    def from_files(cls, filelist, spacing, loader, callback=None):
+        """ Decode the plans in filelist with loader straight into a new stack"""
+
+        data = None
+
+        for i, plan in enumerate(loader.imap(filelist, callback)):
+            if data is None:
+                data = np.empty((len(filelist),) + plan[0].shape, dtype=np.float32)
+            data[i] = plan[0]
+
+        return cls(data, spacing)
+
+    @property
+    def shape(self):
+        return self.data.shape[1:]
+
+    @property
+    def out_of_core(self):
+        return self.cache is not None
+
+    def read_slab(self, z0, z1):
+        """ The planes z0 <= z < z1 of all plans as a (N, z1 - z0, Y, X) array"""
+        if self.out_of_core:
+            return self.cache.read_slab(z0, z1)
+        return self.data[:, z0:z1]
+
+    def volume_image(self, array):
+        """ Wrap a (Z, Y, X) array on the grid of the plans as vtkImageData, without copying it"""
+        return array_to_image(array, self.spacing, self.origin, self.extent)
+
+    def plan_image(self, plan):
+        """ Zero-copy vtkImageData view on a single dose plan"""
+        if plan not in self._plan_images:
+            self._plan_images[plan] = self.volume_image(self.data[plan])
+        return self._plan_images[plan]
+
+    def slice_image(self, plan, z):
+        """ Zero-copy vtkImageData view on the axial slice z of a dose plan"""
+        extent = (0, self.nx - 1, 0, self.ny - 1, z, z)
+        return array_to_image(self.data[plan, z:z + 1], self.spacing, self.origin, extent)
+
+    def voxel(self, x, y, z):
+        """ The dose values of all plans at voxel (x, y, z)"""
+        return self.data[:, z, y, x]
@@ -0,0 +1,150 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import threading
+import numpy as np
+
+from statistics_utils import SlabEngine
+
+
+def offset_table(spacing, radius, distance_criterion):
+    """ The voxel offsets within radius mm, nearest first, and their squared distances in units of distance_criterion.
+
+    spacing is the (x, y, z) voxel spacing in mm, the offsets are returned as a (K, 3) int array of (dz, dy, dx).
+    """
+    halo = [int(np.floor(radius / s)) for s in spacing[::-1]]
+    dz, dy, dx = np.meshgrid(*[np.arange(-h, h + 1) for h in halo], indexing='ij')
+    offsets = np.column_stack((dz.ravel(), dy.ravel(), dx.ravel()))
+
+    squared = ((offsets * np.array(spacing[::-1], dtype=np.float64)) ** 2).sum(axis=1)
+    inside = squared <= radius ** 2 + 1e-9
+    order = np.argsort(squared[inside], kind='mergesort')
+
+    return offsets[inside][order], (squared[inside][order] / distance_criterion ** 2).astype(np.float32)
+
+
+class GammaIndex(SlabEngine):
+    """Class to compute the gamma index of every plan of an ensemble against a reference dose.
+
+	For every voxel of the reference, gamma is the minimum over the voxels of an evaluated plan of
+	sqrt(distance^2 / distance_criterion^2 + dose difference^2 / dose tolerance^2), with a global
+	dose tolerance of dose_criterion percent of the maximum reference dose. The search is bounded
+	to max_gamma * distance_criterion, beyond it gamma is clipped to max_gamma.
+
+	The search window is a table of voxel offsets sorted by distance, computed once. Every slab
+	(with a halo of planes around it) is compared for all plans at once, one vectorized pass per
+	offset, and the search stops as soon as the distance term alone exceeds the largest gamma left.
+	Doses are compared on the voxel grid, without interpolating between voxels.
+
+	compute() only keeps the pass rates, so the search only has to settle gamma in the region above
+	the threshold and the slabs without such voxels are skipped. The gamma volume of a single plan
+	is computed again on demand, over the whole grid, with volume(plan), so the memory stays
+	bounded by the slabs.
+
+	Attributes:
+
+		- dose_tolerance: a float representing the dose difference in Gy that counts as one gamma.
+		- region: a boolean array of shape (Z, Y, X), the voxels above the low dose threshold the pass rates are taken over.
+		- pass_rates: a float array of shape (N,) with the fraction of the region with gamma <= 1 in each plan.
+	"""
+
+    def __init__(self, data, reference, spacing, dose_criterion=3.0, distance_criterion=3.0, threshold=10.0,
+                 max_gamma=2.0, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        self.offsets, self.spatial = offset_table(spacing, max_gamma * distance_criterion, distance_criterion)
+        self.halo = np.abs(self.offsets).max(axis=0)
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+        if slab_depth is None and memory_budget is None:
+            # keep the halo planes, which are read twice, a minority of every slab (a budget caps the depth)
+            self.slab_depth = max(self.slab_depth, 2 * self.halo[0], 1)
+
+        self.reference = np.asarray(reference, dtype=np.float32)
+        maximum = float(self.reference.max())
+        self.dose_tolerance = max(dose_criterion / 100 * maximum, np.finfo(np.float32).tiny)
+        self.max_gamma = max_gamma
+        self.region = self.reference >= threshold / 100 * maximum
+        self.nr_voxels = int(np.count_nonzero(self.region))
+
+        self.passed = np.zeros(self.nr_doseplans, dtype=np.int64)
+        self.pass_rates = None
+        self._lock = threading.Lock()
+
+    def voxel_bytes(self):
+        # the padded slab, the dose differences and the smallest gamma so far
+        return 12 * self.nr_doseplans
+
+    def slab_gamma(self, z0, z1, read_slab, bounded=None):
+        """ The float32 gamma of the planes z0 <= z < z1 of the plans read_slab(e0, e1) returns, for the planes e0 <= z < e1
+
+        Only the voxels of the (depth, Y, X) boolean mask bounded (all voxels when None) are searched until their gamma is
+        final, elsewhere the result is an upper bound.
+        """
+
+        nz = self.data.shape[1]
+        hz, hy, hx = self.halo
+        depth, ny, nx = z1 - z0, self.data.shape[2], self.data.shape[3]
+
+        # the evaluated plans around the slab, the voxels outside the grid never match
+        e0, e1 = max(z0 - hz, 0), min(z1 + hz, nz)
+        evaluated = read_slab(e0, e1)
+        nr_plans = evaluated.shape[0]
+        padded = np.empty((nr_plans, depth + 2 * hz, ny + 2 * hy, nx + 2 * hx), dtype=np.float32)
+        padded.fill(np.inf)
+        padded[:, hz - (z0 - e0):hz + (e1 - z0), hy:hy + ny, hx:hx + nx] = evaluated
+        del evaluated
+
+        reference = self.reference[z0:z1]
+        gamma = np.empty((nr_plans, depth, ny, nx), dtype=np.float32)
+        gamma.fill(self.max_gamma ** 2)
+        difference = np.empty_like(gamma)
+        scale = np.float32(1 / self.dose_tolerance ** 2)
+
+        largest, checked = self.max_gamma ** 2, -1
+        for (dz, dy, dx), spatial in zip(self.offsets, self.spatial):
+            if spatial > checked:
+                # the offsets come in shells of equal distance, the bound only changes between shells
+                largest = gamma.max() if bounded is None else gamma[:, bounded].max()
+                checked = spatial
+            if spatial >= largest:
+                break
+
+            shifted = padded[:, hz + dz:hz + dz + depth, hy + dy:hy + dy + ny, hx + dx:hx + dx + nx]
+            np.subtract(shifted, reference, out=difference)
+            np.multiply(difference, difference, out=difference)
+            difference *= scale
+            difference += spatial
+            np.minimum(gamma, difference, out=gamma)
+
+        np.sqrt(gamma, out=gamma)
+        return gamma
+
+    def compute_slab(self, z0, z1):
+        """ The pass counts of all plans for the reference voxels of the planes z0 <= z < z1"""
+
+        region = self.region[z0:z1]
+        if not region.any():
+            return
+        gamma = self.slab_gamma(z0, z1, self.slab, region)
+        passed = (gamma[:, region] <= 1).sum(axis=1)
+        with self._lock:
+            self.passed += passed
+
+    def volume(self, plan):
+        """ The (Z, Y, X) float32 gamma volume of the plan with index plan, computed slab by slab"""
+
+        gamma = np.empty(self.data.shape[1:], dtype=np.float32)
+        for z0, z1 in self.slabs():
+            gamma[z0:z1] = self.slab_gamma(z0, z1, lambda e0, e1: self.data[plan:plan + 1, e0:e1])[0]
+        return gamma
+
+    def compute(self, callback=None):
+        self.passed.fill(0)
+        SlabEngine.compute(self, callback)
+        self.pass_rates = self.passed / max(self.nr_voxels, 1)
+        return self
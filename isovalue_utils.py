@@ -12,17 +12,17 @@ class Isovalue:
 	
 	Attributes:
 	
+		- stack: an EnsembleStack holding the dose plans in the ensemble, the contours are extracted
+			from its zero-copy plan images.
 		- nr_doseplans: an integer representing the number of dose plans in the ensemble.
-		- doseplans: a dictionary representing the dose plans in the ensemble (VTI data) 
-			{DP1: VTIdata, DP2: VTIdata, (...), DPn: VTIdata}
 	
 	
 	"""
 
-    def __init__(self, nr_doseplans, doseplans, xmin, xmax, ymin, ymax, zmin, zmax, band50, band100):
+    def __init__(self, stack, xmin, xmax, ymin, ymax, zmin, zmax, band50, band100):
 	
-        self.nr_doseplans = nr_doseplans
-        self.doseplans = doseplans
+        self.stack = stack
+        self.nr_doseplans = stack.nr_doseplans
 
         self.extracts_axial = {}
         self.contours_axial = {}
@@ -76,9 +76,9 @@ class Isovalue:
             self.contour_actors_coronal["c{0}".format(i)].GetProperty().SetColor(0,1,0)
             self.contour_actors_coronal["c{0}".format(i)].GetProperty().SetLineWidth(2)
 			
-            self.extracts_axial["c{0}".format(i)].SetInput(self.doseplans["p{0}".format(i)])
-            self.extracts_coronal["c{0}".format(i)].SetInput(self.doseplans["p{0}".format(i)])
-            self.extracts_sagittal["c{0}".format(i)].SetInput(self.doseplans["p{0}".format(i)])
+            self.extracts_axial["c{0}".format(i)].SetInput(self.stack.plan_image(i))
+            self.extracts_coronal["c{0}".format(i)].SetInput(self.stack.plan_image(i))
+            self.extracts_sagittal["c{0}".format(i)].SetInput(self.stack.plan_image(i))
 			
 			
     def setup_isoline_actors(self, plan, sliceA_index,sliceS_index,sliceC_index, isoline_slider, color, opacity):
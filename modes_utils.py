@@ -0,0 +1,119 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import threading
+import numpy as np
+
+from statistics_utils import SlabEngine
+
+
+class GramMatrix(SlabEngine):
+    """Class to compute the N x N Gram matrix of the centred dose plans.
+
+	Every slab is centred on the voxel-wise mean of the plans and multiplied with its own
+	transpose (a BLAS matrix product in double precision), the products of all slabs are summed.
+	Only N x N numbers are kept, the voxel x voxel covariance is never formed. An optional
+	(Z, Y, X) boolean mask restricts the voxels taken into account.
+
+	Attributes:
+
+		- gram: a float64 array of shape (N, N), gram[i, j] is the dot product of the centred plans i and j.
+		- nr_voxels: an integer representing the number of voxels taken into account.
+	"""
+
+    def __init__(self, data, mask=None, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.mask = mask
+        self.nr_voxels = int(np.prod(data.shape[1:])) if mask is None else int(np.count_nonzero(mask))
+        self.gram = np.zeros((self.nr_doseplans, self.nr_doseplans), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def voxel_bytes(self):
+        # the slab values and their centred double precision copy
+        return 12 * self.nr_doseplans
+
+    def centred_slab(self, z0, z1):
+        """ The (N, voxels) double precision dose values of the planes z0 <= z < z1, centred on their mean over the plans"""
+
+        block = self.slab(z0, z1).reshape(self.nr_doseplans, -1)
+        if self.mask is not None:
+            block = block[:, self.mask[z0:z1].ravel()]
+        block = block.astype(np.float64)
+        block -= block.mean(axis=0)
+        return block
+
+    def compute_slab(self, z0, z1):
+        block = self.centred_slab(z0, z1)
+        product = np.dot(block, block.T)
+        with self._lock:
+            self.gram += product
+
+
+class PrincipalModes(GramMatrix):
+    """Class to compute the principal modes of variation of an ensemble of dose plans.
+
+	The centred ensemble X (N plans x V voxels) is decomposed as X = U S W^T. With N much smaller
+	than V, the decomposition follows from the N x N Gram matrix X X^T = U S^2 U^T, which is
+	computed slab by slab. A second pass over the slabs projects the centred plans on the top
+	modes, W^T = S^-1 U^T X, so the memory stays bounded by the slabs and the k mode volumes.
+
+	Attributes:
+
+		- nr_modes: an integer representing the number of computed modes (k).
+		- singular_values: a float array of shape (k,) in decreasing order.
+		- explained: a float array of shape (k,) with the fraction of the total variance of each mode.
+		- scores: a float array of shape (N, k) with the coordinates of every plan along the modes.
+		- modes: a float32 array of shape (k, Z, Y, X) with the unit-norm mode volumes (zero outside the mask).
+	"""
+
+    def __init__(self, data, nr_modes=3, mask=None, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        GramMatrix.__init__(self, data, mask, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.nr_modes = max(1, min(nr_modes, self.nr_doseplans - 1))
+        self.modes = None
+        self._projection = None
+
+    def compute_slab(self, z0, z1):
+        if self._projection is None:
+            GramMatrix.compute_slab(self, z0, z1)
+            return
+
+        block = self.centred_slab(z0, z1)
+        modes = np.dot(self._projection, block)
+
+        planes = self.modes[:, z0:z1].reshape(self.nr_modes, -1)
+        if self.mask is None:
+            planes[...] = modes
+        else:
+            planes[:, self.mask[z0:z1].ravel()] = modes
+
+    def compute(self):
+        # first pass: the Gram matrix
+        SlabEngine.compute(self)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(self.gram)
+        order = np.argsort(eigenvalues)[::-1][:self.nr_modes]
+        eigenvalues = np.maximum(eigenvalues[order], 0)
+        eigenvectors = eigenvectors[:, order]
+
+        self.singular_values = np.sqrt(eigenvalues)
+        self.explained = eigenvalues / max(np.trace(self.gram), np.finfo(np.float64).tiny)
+        self.scores = eigenvectors * self.singular_values
+
+        # second pass: the mode volumes
+        inverse = np.where(self.singular_values > 0, 1 / np.maximum(self.singular_values, np.finfo(np.float64).tiny), 0)
+        self._projection = (eigenvectors * inverse).T
+        self.modes = np.zeros((self.nr_modes,) + self.data.shape[1:], dtype=np.float32)
+        SlabEngine.compute(self)
+        self._projection = None
+
+        return self
@@ -50,14 +50,8 @@ class SelectFromCollection(object):
         self.ind = []
 
     def onselect(self, verts):
-        voxels_xyz = []
         path = Path(verts)
-        self.ind = np.nonzero([path.contains_point(xy) for xy in self.xys])[0]
-        
-        for i in self.ind:
-            voxel_xyz = self.viewer.coordinates[i]
-            voxel_xyz.append(self.viewer.meanx[i])
-            voxels_xyz.append(voxel_xyz)
+        self.ind = np.nonzero(path.contains_points(self.xys))[0]
 		
 		# light blue: 0.1, 1, 1
 		
@@ -76,62 +70,34 @@ class SelectFromCollection(object):
         self.canvas.draw_idle()
         #self.canvas.draw()
 		
-        self.highlight_voxels_2D(voxels_xyz)
+        table = self.viewer.voxel_table
+        coords = table.coordinates[self.ind]
+		
+        self.highlight_voxels_2D(coords)
         #self.canvas.draw_idle()
-        self.highlight_voxels_3D(voxels_xyz)
+        self.highlight_voxels_3D(coords, table.mean[self.ind])
 
 		
 		
     def highlight_voxels_2D(self, coords):
-        newimage = vtk.vtkImageData()
-        newimage.SetSpacing(self.viewer.doseplans["p1"].GetSpacing())
-        newimage.SetOrigin(self.viewer.doseplans["p1"].GetOrigin())
-        newimage.SetDimensions(self.viewer.doseplans["p1"].GetDimensions())
-        newimage.SetExtent(self.viewer.doseplans["p1"].GetExtent())
-        newimage.SetNumberOfScalarComponents(1)
-        newimage.SetScalarTypeToDouble()
-        newimage.AllocateScalars()
-
-        for p in coords:
-		    newimage.SetScalarComponentFromDouble(p[0],p[1],p[2],0, 60)
-			
-        flipYFilter = vtk.vtkImageFlip()
-        flipYFilter.SetFilteredAxis(1)
-        flipYFilter.SetInput(newimage)
-        flipYFilter.Update()
+        # the voxel table uses the orientation of the ensemble stack, no flip is needed
+        stack = self.viewer.stack
+        self.highlight_2D = np.zeros(stack.shape, dtype=np.float64)
+        self.highlight_2D[coords[:, 2], coords[:, 1], coords[:, 0]] = 60
 			
-        self.viewer.refresh_2d(flipYFilter.GetOutput())
+        self.viewer.refresh_2d(stack.volume_image(self.highlight_2D))
 		
 		
 		
-    def highlight_voxels_3D(self, coords):
+    def highlight_voxels_3D(self, coords, values):
 
         self.viewer.ren_iso.RemoveVolume(self.viewer.vol)
 
-        newimage = vtk.vtkImageData()
-        newimage.SetSpacing(self.viewer.volumedata.GetSpacing())
-        newimage.SetOrigin(self.viewer.volumedata.GetOrigin())
-        newimage.SetDimensions(self.viewer.volumedata.GetDimensions())
-        newimage.SetExtent(self.viewer.volumedata.GetExtent())
-        newimage.SetNumberOfScalarComponents(1)
-        newimage.SetScalarTypeToDouble()
-        newimage.AllocateScalars()
-
-        for p in coords:
-		    newimage.SetScalarComponentFromDouble(p[0],p[1],p[2],0, p[3])
-			
-			
-        shift_scale = vtk.vtkImageShiftScale()
-        shift_scale.SetInput(newimage)
-        shift_scale.SetOutputScalarTypeToUnsignedChar()
-        shift_scale.Update()
-		
-        flipYFilter = vtk.vtkImageFlip()
-        flipYFilter.SetFilteredAxis(1)
-        flipYFilter.SetInput(shift_scale.GetOutput())
-        flipYFilter.Update()
+        stack = self.viewer.stack
+        self.highlight_3D = np.zeros(stack.shape, dtype=np.uint8)
+        self.highlight_3D[coords[:, 2], coords[:, 1], coords[:, 0]] = np.clip(values, 0, 255)
 		
-        self.viewer.volMapper.SetInput(flipYFilter.GetOutput())
+        self.viewer.volMapper.SetInput(stack.volume_image(self.highlight_3D))
 		
         self.viewer.ren_iso.AddVolume(self.viewer.vol)
-        self.viewer.refresh_3d()
\ No newline at end of file
+        self.viewer.refresh_3d()
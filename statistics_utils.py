@@ -0,0 +1,829 @@
+# Copyright (c) Pedro Silva, TU Eindhoven.
+# All rights reserved.
+# See COPYRIGHT for details.
+# ---------------------------------------
+
+from __future__ import division
+
+import collections
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+class SlabEngine:
+    """Base class for the computations that walk the ensemble in independent slabs along the Z-axis.
+
+	The slabs are spread over a pool of threads (the NumPy kernels release the GIL). When no slab
+	depth is given, it is chosen so that the working set of one slab fits in cache_size bytes,
+	with voxel_bytes() bytes per voxel.
+
+	For ensembles that do not fit in memory, read_slab(z0, z1) streams the slabs from disk and
+	memory_budget (in bytes) caps the working sets of the slabs (again voxel_bytes() bytes per
+	voxel) that are held by all the workers at the same time.
+
+	plans optionally holds the indices of the plans to take into account, all plans when None.
+
+	Subclasses implement compute_slab(z0, z1). compute() optionally reports its progress to a
+	callback(done, total), called from the calling thread after every slab.
+	"""
+
+    def __init__(self, data, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        self.data = data
+        self.plans = plans
+        self.nr_doseplans = data.shape[0] if plans is None else len(plans)
+        self.read_slab = read_slab
+
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+
+        plane_bytes = data.shape[2] * data.shape[3] * self.voxel_bytes()
+        if memory_budget is not None:
+            # the largest slabs that fit in the budget, this keeps the number of reads from disk low
+            workers = max(1, min(workers, memory_budget // plane_bytes))
+            if slab_depth is None:
+                slab_depth = max(1, memory_budget // (workers * plane_bytes))
+        elif slab_depth is None:
+            slab_depth = max(1, cache_size // plane_bytes)
+
+        self.slab_depth = slab_depth
+        self.workers = workers
+
+    def voxel_bytes(self):
+        """ The bytes per voxel of the working set of a slab"""
+        return 4 * self.nr_doseplans
+
+    def slabs(self):
+        """ The (z0, z1) bounds of the slabs the volume is processed in"""
+        nz = self.data.shape[1]
+        return [(z0, min(z0 + self.slab_depth, nz)) for z0 in range(0, nz, self.slab_depth)]
+
+    def slab(self, z0, z1):
+        """ The (N, z1 - z0, Y, X) dose values of the planes z0 <= z < z1"""
+        if self.read_slab is None:
+            slab = self.data[:, z0:z1]
+        else:
+            slab = self.read_slab(z0, z1)
+        if self.plans is not None:
+            slab = slab[self.plans]
+        return slab
+
+    def compute(self, callback=None):
+        slabs = self.slabs()
+        workers = min(self.workers, len(slabs))
+
+        if workers <= 1:
+            for i, (z0, z1) in enumerate(slabs):
+                self.compute_slab(z0, z1)
+                if callback is not None:
+                    callback(i + 1, len(slabs))
+        else:
+            pool = ThreadPool(workers)
+            try:
+                for i, _ in enumerate(pool.imap_unordered(lambda bounds: self.compute_slab(*bounds), slabs)):
+                    if callback is not None:
+                        callback(i + 1, len(slabs))
+            finally:
+                pool.close()
+                pool.join()
+        return self
+
+
+class EnsembleStatistics(SlabEngine):
+    """Class to compute the voxel-wise statistics of an ensemble of dose plans.
+
+	The statistics are computed slab by slab along the Z-axis. Within a slab the plans are
+	visited twice, once for the sum/minimum/maximum and once for the squared deviations from
+	the mean, while the slab is still in cache. The plans are always accumulated in the same
+	order and in double precision, the results are stored as float32 volumes.
+
+	Every voxel is accumulated in the same plan order, whatever the number of workers or the
+	slab depth, so the results are bit-identical to the serial computation.
+
+	Attributes:
+
+		- mean, minimum, maximum, range, variance, std: float32 arrays of shape (Z, Y, X).
+		- nonzero_count: a uint16 array of shape (Z, Y, X) with the number of plans delivering dose to each voxel.
+		- nr_doseplans: an integer representing the number of dose plans in the ensemble.
+	"""
+
+    NAMES = ['mean', 'minimum', 'maximum', 'range', 'variance', 'std']
+
+    # bytes per voxel of the working set of a slab: the float64 sum and deviation, the float32
+    # minimum, maximum and plan values and the uint16 nonzero count
+    VOXEL_BYTES = 2 * 8 + 3 * 4 + 2
+
+    def __init__(self, data, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget)
+
+        for name in self.NAMES:
+            setattr(self, name, np.empty(data.shape[1:], dtype=np.float32))
+        self.nonzero_count = np.empty(data.shape[1:], dtype=np.uint16)
+
+    def voxel_bytes(self):
+        if self.read_slab is not None:
+            # a slab streamed from disk is a copy of the plan values
+            return self.VOXEL_BYTES + 4 * self.nr_doseplans
+        return self.VOXEL_BYTES
+
+    def compute_slab(self, z0, z1):
+        """ Compute all statistics for the planes z0 <= z < z1"""
+
+        slab = self.slab(z0, z1)
+
+        total = np.zeros(slab.shape[1:], dtype=np.float64)
+        deviation = np.empty(slab.shape[1:], dtype=np.float64)
+        minimum = np.array(slab[0], dtype=np.float32)
+        maximum = np.array(slab[0], dtype=np.float32)
+        nonzero_count = self.nonzero_count[z0:z1]
+        nonzero_count.fill(0)
+
+        for plan in slab:
+            np.add(total, plan, out=total)
+            np.add(nonzero_count, plan != 0, out=nonzero_count)
+            np.minimum(minimum, plan, out=minimum)
+            np.maximum(maximum, plan, out=maximum)
+
+        mean = total / self.nr_doseplans
+
+        total.fill(0)
+        for plan in slab:
+            np.subtract(plan, mean, out=deviation)
+            np.multiply(deviation, deviation, out=deviation)
+            np.add(total, deviation, out=total)
+
+        variance = total / self.nr_doseplans
+
+        self.mean[z0:z1] = mean
+        self.minimum[z0:z1] = minimum
+        self.maximum[z0:z1] = maximum
+        self.variance[z0:z1] = variance
+        np.subtract(maximum, minimum, out=self.range[z0:z1])
+        np.sqrt(variance, out=self.std[z0:z1])
+
+
+class EnsemblePercentiles(SlabEngine):
+    """Class to compute voxel-wise percentiles (median, quartiles, P5/P95) of an ensemble of dose plans.
+
+	Each slab is transposed once into a (voxels, N) block, after which a single partial selection
+	(np.partition with all the needed ranks at once) places the order statistics of every
+	requested percentile, instead of fully sorting the plans of every voxel. The percentiles
+	are interpolated linearly between the closest ranks, like np.percentile does.
+
+	Attributes:
+
+		- percentiles: a tuple with the computed percentiles (0-100).
+		- volumes: a dictionary mapping each percentile to a float32 array of shape (Z, Y, X).
+		- median, iqr: float32 arrays of shape (Z, Y, X), the 50th percentile and the P75 - P25 range (after compute()).
+	"""
+
+    PERCENTILES = (5, 25, 50, 75, 95)
+
+    def __init__(self, data, percentiles=PERCENTILES, plans=None, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.iqr = None
+        self.percentiles = tuple(percentiles)
+        self.volumes = dict((p, np.empty(data.shape[1:], dtype=np.float32)) for p in self.percentiles)
+
+        # the ranks around each percentile and the weight of the upper one
+        self._ranks = {}
+        last = self.nr_doseplans - 1
+        for p in self.percentiles:
+            position = p / 100 * last
+            lower = int(np.floor(position))
+            self._ranks[p] = (lower, min(lower + 1, last), position - lower)
+        self._kth = sorted(set(r for lower, upper, w in self._ranks.values() for r in (lower, upper)))
+
+    @property
+    def median(self):
+        return self.volumes[50]
+
+    def compute(self, callback=None):
+        SlabEngine.compute(self, callback)
+        if 25 in self.volumes and 75 in self.volumes:
+            self.iqr = self.volumes[75] - self.volumes[25]
+        return self
+
+    def compute_slab(self, z0, z1):
+        """ Compute the percentiles for the planes z0 <= z < z1"""
+
+        slab = self.slab(z0, z1)
+        block = np.ascontiguousarray(slab.reshape(self.nr_doseplans, -1).T)
+        block.partition(self._kth, axis=1)
+
+        for p in self.percentiles:
+            lower, upper, weight = self._ranks[p]
+            values = block[:, lower].astype(np.float64)
+            if weight > 0:
+                values += weight * (block[:, upper] - values)
+            self.volumes[p][z0:z1] = values.reshape(slab.shape[1:])
+
+
+class BootstrapStatistics(SlabEngine):
+    """Class to compute bootstrap confidence intervals of the voxel-wise mean and standard deviation of an ensemble.
+
+	A replicate draws N plans with replacement. Instead of copying the resampled plans, the draws
+	are kept as a (B, N) matrix with the number of times each plan is drawn in each replicate, so
+	the sums (and sums of squares) of all B replicates of a slab are two matrix products of the
+	count matrix with the (N, voxels) slab. The slab is centred on its mean first, which keeps the
+	sums of squares accurate in double precision. The draws come from a seeded generator, so the
+	intervals are reproducible. The slabs run in parallel, the matrix products use the BLAS.
+
+	The B replicates of a voxel take far more memory than its plans, so every slab is processed
+	in blocks of block_voxels voxels. A block is sized so that its replicates fit in cache_size
+	bytes, or in half the share of one worker of memory_budget (the slabs get the other half).
+
+	The intervals are the percentile intervals of the B replicates (interpolated between the
+	closest ranks like np.percentile, from a single partial selection), the standard deviation is
+	the population standard deviation like in EnsembleStatistics.
+
+	Attributes:
+
+		- replicates: an integer representing the number of bootstrap replicates (B).
+		- confidence: a float representing the confidence level in percent.
+		- counts: a float64 array of shape (B, N), the number of times every plan is drawn in every replicate.
+		- block_voxels: an integer representing the number of voxels whose replicates are computed at once.
+		- mean_lower, mean_upper, std_lower, std_upper: float32 arrays of shape (Z, Y, X) with the bounds of the intervals.
+	"""
+
+    NAMES = ['mean_lower', 'mean_upper', 'std_lower', 'std_upper']
+
+    def __init__(self, data, replicates=1000, confidence=95.0, seed=0, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None, plans=None):
+
+        self.replicates = replicates
+        if memory_budget is not None:
+            memory_budget //= 2
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        self.confidence = confidence
+        self.seed = seed
+
+        block_budget = cache_size if memory_budget is None else memory_budget // self.workers
+        self.block_voxels = max(1, block_budget // self.replicate_bytes())
+
+        draws = np.random.RandomState(seed).randint(0, self.nr_doseplans, size=(replicates, self.nr_doseplans))
+        draws += np.arange(replicates)[:, np.newaxis] * self.nr_doseplans
+        counts = np.bincount(draws.ravel(), minlength=replicates * self.nr_doseplans)
+        self.counts = counts.reshape(replicates, self.nr_doseplans).astype(np.float64)
+        self._counts = np.ascontiguousarray(self.counts.T)
+
+        # the ranks around the bounds of the interval and the weight of the upper one
+        tail = (100.0 - confidence) / 2
+        self._ranks = []
+        for p in (tail, 100.0 - tail):
+            position = p / 100 * (replicates - 1)
+            lower = int(np.floor(position))
+            self._ranks.append((lower, min(lower + 1, replicates - 1), position - lower))
+        self._kth = sorted(set(r for lower, upper, w in self._ranks for r in (lower, upper)))
+
+        for name in self.NAMES:
+            setattr(self, name, np.empty(data.shape[1:], dtype=np.float32))
+
+    def voxel_bytes(self):
+        # the slab values and their centred double precision copy
+        return 12 * self.nr_doseplans
+
+    def replicate_bytes(self):
+        """ The bytes per voxel of the working set of a block: the squared plans, the sums of the replicates and a temporary"""
+        return 8 * self.nr_doseplans + 24 * self.replicates
+
+    def interval(self, replicates):
+        """ The lower and upper bounds of the interval of (voxels, B) replicates, which are partially sorted in place"""
+
+        replicates.partition(self._kth, axis=1)
+        bounds = []
+        for lower, upper, weight in self._ranks:
+            values = replicates[:, lower].copy()
+            if weight > 0:
+                values += weight * (replicates[:, upper] - values)
+            bounds.append(values)
+        return bounds
+
+    def compute_slab(self, z0, z1):
+        """ Compute the confidence intervals for the planes z0 <= z < z1"""
+
+        block = self.slab(z0, z1).reshape(self.nr_doseplans, -1).astype(np.float64)
+        centre = block.mean(axis=0)
+        block -= centre
+
+        mean_lower, mean_upper, std_lower, std_upper = [getattr(self, name)[z0:z1].reshape(-1) for name in self.NAMES]
+        for v0 in range(0, block.shape[1], self.block_voxels):
+            v1 = min(v0 + self.block_voxels, block.shape[1])
+            values = block[:, v0:v1]
+
+            # (voxels, B) sums of the replicates, contiguous per voxel for the selection of the bounds
+            means = np.dot(values.T, self._counts)
+            means /= self.nr_doseplans
+            variances = np.dot((values * values).T, self._counts)
+            variances /= self.nr_doseplans
+            variances -= np.square(means)
+            np.maximum(variances, 0, out=variances)
+            stds = np.sqrt(variances, out=variances)
+
+            lower, upper = self.interval(means)
+            mean_lower[v0:v1] = lower + centre[v0:v1]
+            mean_upper[v0:v1] = upper + centre[v0:v1]
+            std_lower[v0:v1], std_upper[v0:v1] = self.interval(stds)
+
+
+class ProbabilityCube(SlabEngine):
+    """Class to compute, for a range of isodose thresholds, the fraction of plans delivering at least that dose to every voxel.
+
+	Every plan value is placed once among the sorted thresholds (np.searchsorted), the number of
+	plans per voxel and threshold interval is counted with a single np.bincount, and a reverse
+	cumulative sum over the intervals turns these counts into the number of plans at or above each
+	threshold. The cost is one pass over the ensemble, independent of the number of thresholds.
+
+	The counts are stored as a compact (T, Z, Y, X) cube of unsigned integers.
+
+	Attributes:
+
+		- thresholds: a float array of shape (T,) with the sorted isodose thresholds.
+		- counts: an uint8 (uint16 for more than 255 plans) array of shape (T, Z, Y, X) with the number of plans at or above each threshold.
+	"""
+
+    THRESHOLDS = range(70, 94)
+
+    def __init__(self, data, thresholds=THRESHOLDS, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        self.thresholds = np.sort(np.asarray(thresholds, dtype=np.float32))
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        dtype = np.uint8 if self.nr_doseplans <= np.iinfo(np.uint8).max else np.uint16
+        self.counts = np.empty((len(self.thresholds),) + data.shape[1:], dtype=dtype)
+
+    def voxel_bytes(self):
+        # the slab values and their interval indices, plus the interval counts
+        return 12 * self.nr_doseplans + 8 * (len(self.thresholds) + 1)
+
+    def compute_slab(self, z0, z1):
+        """ Count the plans at or above every threshold for the planes z0 <= z < z1"""
+
+        slab = self.slab(z0, z1).reshape(self.nr_doseplans, -1)
+        nr_voxels = slab.shape[1]
+        nr_intervals = len(self.thresholds) + 1
+
+        # interval j holds the values with exactly j thresholds at or below them
+        intervals = np.searchsorted(self.thresholds, slab, side='right')
+        intervals *= nr_voxels
+        intervals += np.arange(nr_voxels)
+        histogram = np.bincount(intervals.ravel(), minlength=nr_intervals * nr_voxels).reshape(nr_intervals, nr_voxels)
+
+        # plans at or above threshold k are the ones in the intervals above k
+        above = np.cumsum(histogram[::-1], axis=0)[::-1][1:]
+        self.counts[:, z0:z1] = above.reshape((len(self.thresholds), z1 - z0) + self.data.shape[2:])
+
+    def threshold_index(self, threshold):
+        """ The index of threshold in the cube, a KeyError when it was not computed"""
+        index = np.searchsorted(self.thresholds, threshold)
+        if index == len(self.thresholds) or self.thresholds[index] != threshold:
+            raise KeyError(threshold)
+        return index
+
+    def probability(self, threshold):
+        """ The float32 (Z, Y, X) volume with the fraction of plans delivering at least threshold"""
+        return self.counts[self.threshold_index(threshold)] / np.float32(self.nr_doseplans)
+
+
+class HistogramCube(SlabEngine):
+    """Class to hold a dose histogram of the plans for every voxel in the dose region.
+
+	The dose axis is divided in fixed bins of bin_width Gy, from 0 up to max_dose. Only the voxels
+	inside region (typically the voxels where any plan delivers dose) get a row of counts, the
+	rest of the volume is only an entry of -1 in the (Z, Y, X) index map. The counts are stored
+	as uint8 (uint16 for more than 255 plans).
+
+	The distribution of a voxel is then a lookup, and the distribution of a region the sum of its
+	rows.
+
+	Attributes:
+
+		- edges: a float array of shape (B + 1,) with the edges of the dose bins.
+		- index: an int32 array of shape (Z, Y, X) with the row of every voxel in counts, -1 outside the region.
+		- counts: an array of shape (M, B) with the number of plans per dose bin of each voxel in the region.
+	"""
+
+    def __init__(self, data, region, max_dose, bin_width=1.0, slab_depth=None, workers=1,
+                 cache_size=2 * 1024 * 1024, read_slab=None, memory_budget=None, plans=None):
+
+        self.bin_width = bin_width
+        self.edges = np.arange(0, max_dose + bin_width, bin_width, dtype=np.float64)
+        if len(self.edges) < 2:
+            self.edges = np.array([0, bin_width], dtype=np.float64)
+        self.nr_bins = len(self.edges) - 1
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+
+        region = np.asarray(region, dtype=bool)
+        self.index = np.cumsum(region.ravel(), dtype=np.int32).reshape(region.shape) - 1
+        self.index[~region] = -1
+
+        # the rows of the voxels in the planes z0 <= z < z1 are _plane_rows[z0]:_plane_rows[z1]
+        self._plane_rows = np.concatenate(([0], np.cumsum(region.reshape(region.shape[0], -1).sum(axis=1))))
+
+        dtype = np.uint8 if self.nr_doseplans <= np.iinfo(np.uint8).max else np.uint16
+        self.counts = np.zeros((int(self._plane_rows[-1]), self.nr_bins), dtype=dtype)
+
+    def voxel_bytes(self):
+        # the slab values and their bin indices, plus the bin counts
+        return 12 * self.nr_doseplans + 8 * self.nr_bins
+
+    @property
+    def bin_centers(self):
+        return (self.edges[:-1] + self.edges[1:]) / 2
+
+    def compute_slab(self, z0, z1):
+        """ Fill the histograms of the region voxels in the planes z0 <= z < z1"""
+
+        row0, row1 = self._plane_rows[z0], self._plane_rows[z1]
+        if row0 == row1:
+            return
+
+        inside = self.index[z0:z1].ravel() >= 0
+        values = self.slab(z0, z1).reshape(self.nr_doseplans, -1)[:, inside]
+        nr_voxels = values.shape[1]
+
+        bins = (values / self.bin_width).astype(np.int64)
+        np.clip(bins, 0, self.nr_bins - 1, out=bins)
+        bins += np.arange(nr_voxels)[np.newaxis] * self.nr_bins
+
+        self.counts[row0:row1] = np.bincount(bins.ravel(), minlength=nr_voxels * self.nr_bins).reshape(nr_voxels, self.nr_bins)
+
+    def histogram(self, x, y, z):
+        """ The counts per dose bin at voxel (x, y, z), zeros outside the region"""
+        row = self.index[z, y, x]
+        if row < 0:
+            return np.zeros(self.nr_bins, dtype=self.counts.dtype)
+        return self.counts[row]
+
+    def region_histogram(self, mask, z=None):
+        """ The summed counts per dose bin of the voxels selected by a boolean (Z, Y, X) mask, or (Y, X) mask of plane z"""
+        index = self.index if z is None else self.index[z]
+        rows = index[mask]
+        return self.counts[rows[rows >= 0]].sum(axis=0, dtype=np.int64)
+
+
+class BinnedDensity:
+    """Class to evaluate kernel density estimates of the voxel dose distributions on the bins of a HistogramCube.
+
+	The estimate of a voxel is its histogram convolved (with an FFT) with a Gaussian kernel sampled
+	on the same dose grid, the bandwidth follows Scott's rule from the binned standard deviation.
+	The densities of the most recently probed voxels are kept in a bounded LRU cache, so moving
+	back over a probed area does not evaluate them again.
+
+	Attributes:
+
+		- cube: the HistogramCube the densities are evaluated from.
+		- grid: a float array of shape (B,) with the doses (bin centers) the densities are given at.
+		- cache_size: an integer representing the maximum number of voxel densities that are kept.
+	"""
+
+    def __init__(self, cube, cache_size=512):
+
+        self.cube = cube
+        self.grid = cube.bin_centers
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def density(self, x, y, z):
+        """ The density of the doses of voxel (x, y, z) on grid, zeros outside the dose region"""
+
+        key = (x, y, z)
+        if key in self._cache:
+            # most recently used entries are kept at the end
+            value = self._cache.pop(key)
+        else:
+            value = self.estimate(self.cube.histogram(x, y, z))
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[key] = value
+        return value
+
+    def region_density(self, mask, z=None):
+        """ The density of the doses of all voxels selected by mask (see HistogramCube.region_histogram)"""
+        return self.estimate(self.cube.region_histogram(mask, z))
+
+    def estimate(self, counts):
+        """ Binned Gaussian kernel density estimate of a histogram on grid"""
+
+        counts = np.asarray(counts, dtype=np.float64)
+        total = counts.sum()
+        width = self.cube.bin_width
+        if total == 0:
+            return np.zeros(len(counts))
+
+        mean = np.dot(counts, self.grid) / total
+        std = np.sqrt(np.dot(counts, (self.grid - mean) ** 2) / total)
+        bandwidth = max(std * total ** (-1 / 5), width / 2)
+
+        # kernel sampled on the bin offsets, truncated at 4 bandwidths
+        reach = int(min(np.ceil(4 * bandwidth / width), len(counts)))
+        offsets = np.arange(-reach, reach + 1) * width
+        kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+
+        size = 1
+        while size < len(counts) + len(kernel) - 1:
+            size *= 2
+        density = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)[reach:reach + len(counts)]
+
+        np.maximum(density, 0, out=density)
+        return density / (density.sum() * width)
+
+
+class RunningStatistics:
+    """Class to fold the dose plans into the voxel-wise statistics one at a time, as they are decoded.
+
+	The running mean and sum of squared deviations (M2) are updated with Welford's method in
+	double precision, so every plan is visited once and can be dropped afterwards. refresh()
+	publishes the current estimates in the same float32 attributes as EnsembleStatistics, so
+	the overlays can show them while the rest of the ensemble is still loading.
+
+	Attributes:
+
+		- nr_doseplans: an integer representing the number of plans folded in so far.
+		- mean, minimum, maximum, range, variance, std: float32 arrays of shape (Z, Y, X), valid after refresh().
+		- nonzero_count: a uint16 array of shape (Z, Y, X) with the number of plans folded in delivering dose to each voxel.
+	"""
+
+    def __init__(self, shape):
+
+        self.nr_doseplans = 0
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self._delta = np.empty(shape, dtype=np.float64)
+
+        for name in EnsembleStatistics.NAMES:
+            setattr(self, name, np.zeros(shape, dtype=np.float32))
+        self.nonzero_count = np.zeros(shape, dtype=np.uint16)
+
+    def add(self, plan):
+        """ Fold a single (Z, Y, X) dose plan into the running statistics"""
+
+        self.nr_doseplans += 1
+
+        if self.nr_doseplans == 1:
+            self.minimum[...] = plan
+            self.maximum[...] = plan
+        else:
+            np.minimum(self.minimum, plan, out=self.minimum)
+            np.maximum(self.maximum, plan, out=self.maximum)
+        self.nonzero_count += plan != 0
+
+        # delta = x - mean_old, mean += delta / n, M2 += delta * (x - mean_new)
+        np.subtract(plan, self._mean, out=self._delta)
+        self._mean += self._delta / self.nr_doseplans
+        self._delta *= plan - self._mean
+        self._m2 += self._delta
+
+    def refresh(self):
+        """ Publish the current estimates in the float32 statistics volumes"""
+
+        self.mean[...] = self._mean
+        self.variance[...] = self._m2 / max(self.nr_doseplans, 1)
+        np.sqrt(self.variance, out=self.std)
+        np.subtract(self.maximum, self.minimum, out=self.range)
+        return self
+
+
+class PlanSelection(SlabEngine):
+    """Class to include or exclude single plans from the statistics of an ensemble.
+
+	The per-voxel sum and sum of squares over the included plans are kept in double precision, so
+	toggling a plan updates the mean, variance, std and nonzero count in a single pass over the
+	voxels. The sums are taken of the deviations from the mean of all plans, which keeps the
+	variance (sum of squares / n - mean^2) accurate. The minimum and maximum only have to be
+	searched again at the voxels where the excluded plan held the extreme value and the plans
+	differ (outside the dose region all plans are 0). The results are written in place into the
+	volumes of the statistics object, so every image wrapping them sees the new values.
+
+	The sums are accumulated slab by slab by compute(), so an out-of-core ensemble is streamed
+	like in the other engines. Toggling a plan reads that plan, and the slabs holding voxels where
+	it was the only extreme.
+
+	Attributes:
+
+		- included: a boolean array of shape (N,) flagging the plans that are part of the statistics.
+		- statistics: the EnsembleStatistics object that is kept up to date.
+	"""
+
+    def __init__(self, data, statistics, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget)
+
+        self.statistics = statistics
+        self.included = np.ones(data.shape[0], dtype=bool)
+
+        self._shift = np.array(statistics.mean, dtype=np.float32)
+        self._sum = np.empty(data.shape[1:], dtype=np.float64)
+        self._sumsq = np.empty(data.shape[1:], dtype=np.float64)
+
+    def voxel_bytes(self):
+        # the slab values and their double precision copy
+        return 12 * self.nr_doseplans
+
+    def compute_slab(self, z0, z1):
+        """ Sum the plans and their squares for the planes z0 <= z < z1"""
+
+        block = self.slab(z0, z1).astype(np.float64)
+        block -= self._shift[z0:z1]
+        block.sum(axis=0, out=self._sum[z0:z1])
+        block *= block
+        block.sum(axis=0, out=self._sumsq[z0:z1])
+
+    def set_included(self, plan, included):
+        """ Include or exclude a plan, returns False when nothing changed"""
+
+        if self.included[plan] == included:
+            return False
+        if not included and np.count_nonzero(self.included) == 1:
+            raise ValueError("At least one dose plan has to stay included")
+
+        values = self.data[plan]
+        plan_data = values - self._shift.astype(np.float64)
+        statistics = self.statistics
+        self.included[plan] = included
+
+        if included:
+            self._sum += plan_data
+            plan_data *= plan_data
+            self._sumsq += plan_data
+            statistics.nonzero_count += values != 0
+            np.minimum(statistics.minimum, values, out=statistics.minimum)
+            np.maximum(statistics.maximum, values, out=statistics.maximum)
+        else:
+            self._sum -= plan_data
+            plan_data *= plan_data
+            self._sumsq -= plan_data
+            statistics.nonzero_count -= values != 0
+
+            # where the minimum is the maximum all plans are equal, and stay so without this plan
+            differ = statistics.minimum != statistics.maximum
+            extremes = ((statistics.minimum, np.min), (statistics.maximum, np.max))
+            for z0, z1 in self.slabs():
+                stale = [(extreme[z0:z1], reduce, (values[z0:z1] == extreme[z0:z1]) & differ[z0:z1])
+                         for extreme, reduce in extremes]
+                if not any(mask.any() for extreme, reduce, mask in stale):
+                    continue
+                slab = self.slab(z0, z1)[self.included]
+                for extreme, reduce, mask in stale:
+                    extreme[mask] = reduce(slab[:, mask], axis=0)
+
+        self.update()
+        return True
+
+    def update(self):
+        """ Write the mean, variance, std and range of the included plans into the statistics volumes"""
+
+        statistics = self.statistics
+        statistics.nr_doseplans = count = np.count_nonzero(self.included)
+
+        mean = self._sum / count
+        variance = self._sumsq / count
+        variance -= mean * mean
+        np.maximum(variance, 0, out=variance)
+        mean += self._shift
+
+        statistics.mean[...] = mean
+        statistics.variance[...] = variance
+        np.sqrt(statistics.variance, out=statistics.std)
+        np.subtract(statistics.maximum, statistics.minimum, out=statistics.range)
+
+
+class PlanInfluence(SlabEngine):
+    """Class to compute how much the mean and std volumes of an ensemble change when a single plan is left out.
+
+	With the mean m and variance v of the N plans, leaving out a plan with dose x gives, per voxel,
+	the mean m - (x - m) / (N - 1) and the variance (N v - N / (N - 1) (x - m)^2) / (N - 1). These
+	closed-form updates from the cached statistics replace N recomputations of the statistics, one
+	pass over the ensemble gives the influence of every plan at once.
+
+	Attributes:
+
+		- statistics: the EnsembleStatistics of the plans taken into account.
+		- nr_voxels: an integer representing the number of voxels (in the optional mask) the influence is summarized over.
+		- mean_change, std_change: float arrays of shape (N,), the root mean square change of the mean and std when leaving out each plan.
+		- max_mean_change, max_std_change: float arrays of shape (N,), the largest absolute change of the mean and std.
+	"""
+
+    def __init__(self, data, statistics, mask=None, slab_depth=None, workers=1, cache_size=2 * 1024 * 1024,
+                 read_slab=None, memory_budget=None, plans=None):
+
+        SlabEngine.__init__(self, data, slab_depth, workers, cache_size, read_slab, memory_budget, plans)
+        if self.nr_doseplans < 2:
+            raise ValueError("Leaving out a dose plan needs at least two dose plans")
+
+        self.statistics = statistics
+        self.mask = mask
+        self.nr_voxels = int(np.prod(data.shape[1:])) if mask is None else int(np.count_nonzero(mask))
+
+        self._squares = np.zeros((2, self.nr_doseplans), dtype=np.float64)
+        self._maxima = np.zeros((2, self.nr_doseplans), dtype=np.float64)
+        self._lock = threading.Lock()
+
+    def voxel_bytes(self):
+        # the slab values, the deviations and the two changes in double precision
+        return 28 * self.nr_doseplans
+
+    def changes(self, values, z0=0, z1=None):
+        """ The change of the mean and std when leaving out the plan(s) with the given values for the planes z0 <= z < z1"""
+
+        n = self.nr_doseplans
+        mean = self.statistics.mean[z0:z1].astype(np.float64)
+        variance = self.statistics.variance[z0:z1].astype(np.float64)
+
+        deviation = values - mean
+        mean_change = deviation / -(n - 1)
+
+        deviation *= deviation
+        deviation *= -n / (n - 1)
+        deviation += n * variance
+        np.maximum(deviation, 0, out=deviation)
+        std_change = np.sqrt(deviation / (n - 1))
+        std_change -= np.sqrt(variance)
+
+        return mean_change, std_change
+
+    def maps(self, plan):
+        """ The (Z, Y, X) float32 change of the mean and std volumes when leaving out the plan with index plan"""
+        mean_change, std_change = self.changes(self.data[plan].astype(np.float64))
+        return mean_change.astype(np.float32), std_change.astype(np.float32)
+
+    def compute_slab(self, z0, z1):
+        """ Sum the changes of all plans over the voxels of the planes z0 <= z < z1"""
+
+        slab = self.slab(z0, z1)
+        changes = self.changes(slab.astype(np.float64), z0, z1)
+
+        squares = np.empty((2, self.nr_doseplans), dtype=np.float64)
+        maxima = np.zeros((2, self.nr_doseplans), dtype=np.float64)
+        for i, change in enumerate(changes):
+            change = change.reshape(self.nr_doseplans, -1)
+            if self.mask is not None:
+                change = change[:, self.mask[z0:z1].ravel()]
+            squares[i] = np.einsum('ij,ij->i', change, change)
+            if change.shape[1] > 0:
+                maxima[i] = np.abs(change).max(axis=1)
+
+        with self._lock:
+            self._squares += squares
+            np.maximum(self._maxima, maxima, out=self._maxima)
+
+    def compute(self, callback=None):
+        self._squares.fill(0)
+        self._maxima.fill(0)
+        SlabEngine.compute(self, callback)
+        self.mean_change, self.std_change = np.sqrt(self._squares / max(self.nr_voxels, 1))
+        self.max_mean_change, self.max_std_change = self._maxima
+        return self
+
+
+class VoxelTable:
+    """Class to hold the features of every voxel in the dose region as flat arrays.
+
+	A voxel is part of the table when the first three plans of the ensemble deliver dose to it.
+	The table is built with array masks over the ensemble and its statistics, and feeds the
+	scatterplot and the lasso selection directly.
+
+	Attributes:
+
+		- coordinates: an integer array of shape (M, 3) with the (x, y, z) index of each voxel.
+		- mean, std: float32 arrays of shape (M,) with the mean and standard deviation of each voxel.
+		- count: an array of shape (M,) with the number of plans delivering dose to each voxel.
+		- bounds: a tuple (x0, x1, y0, y1, z0, z1) with the region the table was built for.
+	"""
+
+    def __init__(self, data, statistics, bounds=None):
+
+        nz, ny, nx = data.shape[1:]
+        if bounds is None:
+            bounds = (0, nx, 0, ny, 0, nz)
+
+        self.bounds = bounds
+        x0, x1, y0, y1, z0, z1 = bounds
+        region = (slice(z0, z1), slice(y0, y1), slice(x0, x1))
+
+        mask = np.ones((z1 - z0, y1 - y0, x1 - x0), dtype=bool)
+        for plan in data[:3]:
+            mask &= plan[region] != 0
+
+        zz, yy, xx = np.nonzero(mask)
+        self.coordinates = np.column_stack((xx + x0, yy + y0, zz + z0))
+
+        self.mean = statistics.mean[region][mask]
+        self.std = statistics.std[region][mask]
+        self.count = statistics.nonzero_count[region][mask]
+
+    def __len__(self):
+        return len(self.mean)